@@ -4,12 +4,443 @@
 Kubectl plugin to show all network policy
 """
 
+import argparse
+import collections
+import email.utils
+import functools
+import heapq
+import io
+import ipaddress
+import itertools
+import logging
+import os
+import random
 import sys
+import threading
+import time
 import pprint
+import queue
 import requests
 import kubernetes
 
 
+# Request priority classes. Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Api server status codes that mean the request should be retried
+RETRY_STATUS = (429, 503, 504)
+
+log = logging
+# Request schedulers by kubeconfig context (None is the active context)
+scheduler_limits = None
+schedulers = dict()
+schedulers_lock = threading.Lock()
+
+
+##############################################################################
+# Parses the command line arguments
+##############################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(description='netpol')
+    parser.add_argument('--debug', '-d',
+                        action='store_true',
+                        dest='debug',
+                        help='debug flag')
+    add_scheduler_parameters(parser)
+    parser.add_argument('--analyze',
+                        action='store_true',
+                        dest='analyze',
+                        help='report duplicate, shadowed and allow-all '
+                             'ingress rules on all namespaces')
+    parser.add_argument('--pods',
+                        action='store_true',
+                        dest='pods',
+                        help='show ingress and egress evaluation for each pod')
+    parser.add_argument('--watch', '-w',
+                        action='store_true',
+                        dest='watch',
+                        help='with --pods, keep evaluation updated from '
+                             'watch events')
+    add_context_parameters(parser)
+    args = parser.parse_args()
+    if args.watch and not args.pods:
+        parser.error('--watch requires --pods')
+    if args.watch and (args.contexts or args.all_contexts):
+        parser.error('--watch can not be used with multiple contexts')
+    return args
+
+
+def add_scheduler_parameters(parser):
+    """
+    Add the api request scheduler options to an argparse parser.
+    Defaults are read from the environment, so the limits can be set once
+    for all plugins. argparse converts them with type, so an invalid value
+    is reported as an usage error.
+    """
+    group = parser.add_argument_group('API request limits')
+    group.add_argument('--qps',
+                       type=float,
+                       default=os.environ.get('KUBECTL_PLUGINS_QPS', '5'),
+                       help='max requests per second sent to the api server '
+                            '(env KUBECTL_PLUGINS_QPS, default: %(default)s)')
+    group.add_argument('--burst',
+                       type=int,
+                       default=os.environ.get('KUBECTL_PLUGINS_BURST', '10'),
+                       help='max burst of requests above qps '
+                            '(env KUBECTL_PLUGINS_BURST, default: %(default)s)')
+    group.add_argument('--max-inflight',
+                       type=int,
+                       dest='max_inflight',
+                       default=os.environ.get('KUBECTL_PLUGINS_MAX_INFLIGHT', '4'),
+                       help='max requests running at the same time '
+                            '(env KUBECTL_PLUGINS_MAX_INFLIGHT, default: %(default)s)')
+    group.add_argument('--retries',
+                       type=int,
+                       default=os.environ.get('KUBECTL_PLUGINS_RETRIES', '3'),
+                       help='max retries for throttled requests '
+                            '(env KUBECTL_PLUGINS_RETRIES, default: %(default)s)')
+
+
+def add_context_parameters(parser):
+    """
+    Add the multi-cluster options to an argparse parser
+    """
+    group = parser.add_argument_group('Multi-cluster')
+    contexts = group.add_mutually_exclusive_group()
+    contexts.add_argument('--contexts',
+                          type=lambda value: [i for i in value.split(',') if i],
+                          dest='contexts',
+                          metavar='CTX1,CTX2',
+                          help='kubeconfig contexts to query concurrently')
+    contexts.add_argument('--all-contexts',
+                          action='store_true',
+                          dest='all_contexts',
+                          help='query all kubeconfig contexts concurrently')
+    group.add_argument('--timeout',
+                       type=float,
+                       default=60,
+                       help='max seconds to wait for each cluster '
+                            '(default: %(default)s)')
+
+
+def get_scheduler(context=None):
+    """
+    Return the request scheduler for the context, creating it on first use.
+    Each cluster has its own api server, so each one has its own limits.
+    Return None if the scheduler limits are not configured.
+    """
+    if scheduler_limits is None:
+        return None
+    with schedulers_lock:
+        if context not in schedulers:
+            schedulers[context] = RequestScheduler(**scheduler_limits)
+        return schedulers[context]
+
+
+class ThreadLocalStdout():
+    """
+    sys.stdout replacement that sends the output of threads running
+    through run() to a buffer per thread. Other threads write to stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, 'buffer', None) or self.stream
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def run(self, func, *args):
+        """
+        Run func(*args) capturing its output
+
+        Return:
+            output, error (None if func completed successfully)
+        """
+        self._local.buffer = io.StringIO()
+        error = None
+        try:
+            func(*args)
+        except SystemExit as exc:
+            error = 'exited with code {}'.format(exc.code)
+        except Exception as exc:
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        finally:
+            output = self._local.buffer.getvalue()
+            self._local.buffer = None
+        return output, error
+
+
+def run_on_contexts(contexts, func, *, timeout=None):
+    """
+    Run func(context) concurrently for all contexts. A failure or timeout
+    on one cluster does not affect the others.
+
+    Arguments:
+        contexts (list): kubeconfig contexts names
+        func     (func): function called with the context name
+
+    Keyword arguments (opt):
+        timeout (float): max seconds to wait for the clusters
+
+    Return:
+        list of (context, output, error) in the same order as contexts
+    """
+    if not isinstance(sys.stdout, ThreadLocalStdout):
+        sys.stdout = ThreadLocalStdout(sys.stdout)
+    capture = sys.stdout
+
+    outputs = [None] * len(contexts)
+
+    def worker(pos, context):
+        outputs[pos] = capture.run(func, context)
+
+    # Daemon threads: a cluster that timed out does not keep the process
+    # running after the report
+    threads = [threading.Thread(target=worker, args=(pos, context),
+                                daemon=True)
+               for pos, context in enumerate(contexts)]
+    for thread in threads:
+        thread.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for thread in threads:
+        thread.join(None if deadline is None
+                    else max(0, deadline - time.monotonic()))
+
+    results = list()
+    for context, output in zip(contexts, outputs):
+        if output is None:
+            results.append((context, '',
+                            'timed out after {}s'.format(timeout)))
+        else:
+            results.append((context,) + output)
+    return results
+
+
+def show_contexts_report(results):
+    """
+    Show the output of each cluster tagged by context name.
+    Outputs are shown one cluster after the other, they are not merged.
+
+    Return:
+        number of clusters that failed
+    """
+    failed = [context for context, _, error in results if error]
+    for context, output, error in results:
+        msg("blue", "Cluster: {}".format(context))
+        if output:
+            print(output, end='' if output.endswith('\n') else '\n')
+        if error:
+            msg("red", "  Error: {}".format(error))
+    msg("cyan", "{}/{} clusters ok".format(len(results) - len(failed),
+                                           len(results)))
+    if failed:
+        msg("red", "Failed clusters: {}".format(', '.join(failed)))
+    return len(failed)
+
+
+def setup_logging(logfile=None, *,
+                  filemode='a', date_format=None, log_level='DEBUG'):
+    """
+    Configure logging
+
+    Arguments (opt):
+        logfile     (str): log file to write the log messages
+                               If not specified, it shows log messages
+                               on screen (stderr)
+    Keyword arguments (opt):
+        filemode    (a/w): a - log messages are appended to the file (default)
+                           w - log messages overwrite the file
+        date_format (str): date format in strftime format
+                           default is %m/%d/%Y %H:%M:%S
+        log_level   (str): specifies the lowest-severity log message
+                           DEBUG, INFO, WARNING, ERROR or CRITICAL
+                           default is DEBUG
+    """
+    dict_level = {'DEBUG': logging.DEBUG,
+                  'INFO': logging.INFO,
+                  'WARNING': logging.WARNING,
+                  'ERROR': logging.ERROR,
+                  'CRITICAL': logging.CRITICAL}
+
+    if log_level not in dict_level:
+        raise ValueError("Invalid log_level")
+    if filemode not in ['a', 'w']:
+        raise ValueError("Invalid filemode")
+
+    if not date_format:
+        date_format = '%m/%d/%Y %H:%M:%S'
+
+    log_fmt = '%(asctime)s %(module)s %(funcName)s %(levelname)s %(message)s'
+
+    try:
+        logging.basicConfig(level=dict_level[log_level],
+                            format=log_fmt,
+                            datefmt=date_format,
+                            filemode=filemode,
+                            filename=logfile)
+    except:
+        raise
+
+    return logging.getLogger(__name__)
+
+
+class RetryableRequest(Exception):
+    """
+    Raised by a request function to ask the scheduler to retry it
+
+    Arguments (opt):
+        retry_after (float): seconds the server asked us to wait
+        result           : value returned to the caller when retries
+                           are exhausted. If None, the exception is raised
+    """
+    def __init__(self, retry_after=None, result=None):
+        super().__init__(retry_after, result)
+        self.retry_after = retry_after
+        self.result = result
+
+
+class RequestScheduler():
+    """
+    Client side scheduler for api server requests.
+
+    Every request takes a token from a token bucket (qps/burst), waits for
+    a free in-flight slot and is served by priority (lower value first,
+    FIFO within the same priority). Requests raising RetryableRequest are
+    retried with exponential backoff and full jitter, honoring the
+    server Retry-After when informed.
+    """
+    def __init__(self, *, qps=5.0, burst=10, max_inflight=4, retries=3,
+                 backoff=0.5, max_backoff=30.0):
+        if qps <= 0 or burst < 1 or max_inflight < 1 or retries < 0:
+            raise ValueError("Invalid scheduler limits")
+        self.qps = qps
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counters = collections.Counter()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._inflight = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _count(self, name):
+        with self._cond:
+            self.counters[name] += 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last_refill) * self.qps)
+        self._last_refill = now
+
+    def _acquire(self, priority):
+        """
+        Block until the request is the highest priority one waiting,
+        there is a free in-flight slot and a token available
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            queued = throttled = False
+            while True:
+                if self._waiting[0] != ticket or \
+                   self._inflight >= self.max_inflight:
+                    queued = True
+                    self._cond.wait()
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    break
+                throttled = True
+                self._cond.wait((1 - self._tokens) / self.qps)
+            self.counters['queued'] += queued
+            self.counters['throttled'] += throttled
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._inflight += 1
+            self.counters['wait_ms'] += int((time.monotonic() - start) * 1000)
+            self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def _delay(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = min(self.max_backoff, retry_after) + delay / 2
+        return delay
+
+    def call(self, func, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Run func(*args, **kwargs) under the scheduler limits
+
+        Keyword arguments (opt):
+            priority (int): request priority class, default is
+                            PRIORITY_INTERACTIVE
+        """
+        self._count('requests')
+        attempt = 0
+        while True:
+            self._acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except RetryableRequest as exc:
+                if attempt >= self.retries:
+                    self._count('failed')
+                    if exc.result is None:
+                        raise
+                    return exc.result
+                delay = self._delay(attempt, exc.retry_after)
+                log.debug("Request throttled, retry %s/%s in %.2fs",
+                          attempt + 1, self.retries, delay)
+                self._count('retries')
+                attempt += 1
+            finally:
+                self._release()
+            time.sleep(delay)
+
+    def stats(self):
+        """
+        Return scheduler counters
+        """
+        with self._cond:
+            return dict(self.counters, inflight=self._inflight,
+                        waiting=len(self._waiting))
+
+
+def parse_retry_after(value):
+    """
+    Return Retry-After header value (seconds or http-date) in seconds,
+    or None if it can not be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
 def msg(color, msg_text, exitcode=0, *, end='\n'):
     """
     Print colored text.
@@ -58,15 +489,34 @@ class K8s():
     """
     Class to handle Kubernetes api
     """
-    def __init__(self):
-        kubernetes.config.load_kube_config()
-        configuration = kubernetes.client.Configuration()
+    def __init__(self, context=None, *, request_timeout=None):
+        """
+        Arguments (opt):
+            context         (str): kubeconfig context, default is the
+                                   active context
+
+        Keyword arguments (opt):
+            request_timeout (float): timeout in seconds for each api request
+        """
+        if context:
+            configuration = kubernetes.client.Configuration()
+            kubernetes.config.load_kube_config(
+                context=context, client_configuration=configuration)
+        else:
+            kubernetes.config.load_kube_config()
+            configuration = kubernetes.client.Configuration()
         configuration.verify_ssl = False
         api_client = kubernetes.client.ApiClient(configuration)
 
+        self.context = context
+        self.request_timeout = request_timeout
+        self.scheduler = get_scheduler(context)
         self.corev1api = kubernetes.client.CoreV1Api(api_client)
         self.networkingv1api = kubernetes.client.NetworkingV1Api(api_client)
-        self.active_namespace = self.get_active_context_namespace()
+        if context:
+            self.active_namespace = self.get_context_namespace(context)
+        else:
+            self.active_namespace = self.get_active_context_namespace()
 
     @classmethod
     def get_active_context_namespace(cls):
@@ -80,20 +530,108 @@ class K8s():
 
         return active_context['context']['namespace']
 
+    @staticmethod
+    def get_context_namespace(context):
+        """
+        Return namespace for the context
+        """
+        contexts, _ = kubernetes.config.list_kube_config_contexts()
+        for ctx in contexts:
+            if ctx['name'] == context:
+                return ctx['context'].get('namespace', 'default')
+        raise ValueError("Context not found in kube-config file: {}".
+                         format(context))
+
+    @staticmethod
+    def list_contexts():
+        """
+        Return all kubeconfig contexts names
+        """
+        contexts, _ = kubernetes.config.list_kube_config_contexts()
+        return [ctx['name'] for ctx in contexts]
+
+    def call_api(self, func, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Call a kubernetes api method through the request scheduler.
+        Throttled requests (429/503/504) are retried honoring Retry-After.
+        """
+        if self.request_timeout:
+            kwargs.setdefault('_request_timeout', self.request_timeout)
+
+        def _call():
+            try:
+                return func(*args, **kwargs)
+            except kubernetes.client.rest.ApiException as exc:
+                if exc.status not in RETRY_STATUS:
+                    raise
+                headers = exc.headers or {}
+                raise RetryableRequest(
+                    retry_after=parse_retry_after(headers.get('Retry-After'))
+                ) from exc
+
+        if self.scheduler is None:
+            return func(*args, **kwargs)
+        try:
+            return self.scheduler.call(_call, priority=priority)
+        except RetryableRequest as exc:
+            raise exc.__cause__
+
     def get_namespaces(self):
-        namespaces = self.corev1api.list_namespace(watch=False)
+        namespaces = self.call_api(self.corev1api.list_namespace, watch=False)
         return [i.metadata.name for i in namespaces.items]
 
     def list_all_networkpolicy(self):
-        return self.networkingv1api.list_network_policy_for_all_namespaces()
+        return self.call_api(
+            self.networkingv1api.list_network_policy_for_all_namespaces,
+            priority=PRIORITY_BULK)
 
     def list_networkpolicy(self, namespace):
-        return self.networkingv1api.list_namespaced_network_policy(namespace)
+        return self.call_api(
+            self.networkingv1api.list_namespaced_network_policy, namespace)
 
     def read_networkpolicy(self, namespace, network_policy_name):
-        return self.networkingv1api.read_namespaced_network_policy(
+        return self.call_api(
+            self.networkingv1api.read_namespaced_network_policy,
             network_policy_name, namespace)
 
+    def list_namespaces(self):
+        return self.call_api(self.corev1api.list_namespace,
+                             priority=PRIORITY_BULK)
+
+    def list_all_pods(self):
+        return self.call_api(self.corev1api.list_pod_for_all_namespaces,
+                             priority=PRIORITY_BULK)
+
+    def watch(self, kind, events, resource_version, stop):
+        """
+        Send watch events for the kind (Namespace, Pod or NetworkPolicy)
+        to the events queue as (stop, kind, event), starting from
+        resource_version. Run until stop (threading.Event) is set; when the
+        watch can not be resumed it sends (stop, 'RESYNC', None) and returns.
+        """
+        funcs = {'Namespace': self.corev1api.list_namespace,
+                 'Pod': self.corev1api.list_pod_for_all_namespaces,
+                 'NetworkPolicy':
+                     self.networkingv1api.list_network_policy_for_all_namespaces}
+        while not stop.is_set():
+            watch = kubernetes.watch.Watch()
+            try:
+                for event in watch.stream(funcs[kind],
+                                          resource_version=resource_version,
+                                          timeout_seconds=300):
+                    if stop.is_set():
+                        watch.stop()
+                        return
+                    if event['type'] == 'ERROR':
+                        raise ValueError(event['raw_object'])
+                    resource_version = \
+                        event['object'].metadata.resource_version
+                    events.put((stop, kind, event))
+            except Exception as exc:
+                log.debug("Watch %s stopped: %s", kind, exc)
+                events.put((stop, 'RESYNC', None))
+                return
+
 
 ##############################################################################
 # Show target Pods for the network policy
@@ -127,9 +665,9 @@ def show_networkpolicy_dest_ports(ingress_from_entry):
 
 
 ##############################################################################
-# Show network policy source traffic details
+# Show network policy source/destination traffic details
 ##############################################################################
-def show_ingress_entry_from(entry_from, add_new_line):
+def show_networkpolicy_peer(entry_from, add_new_line, *, direction='From'):
     if not entry_from.ip_block and \
        not entry_from.namespace_selector and \
        not entry_from.pod_selector.match_expressions and \
@@ -141,7 +679,7 @@ def show_ingress_entry_from(entry_from, add_new_line):
         msg("nocolor", "")
 
     if entry_from.namespace_selector:
-        msg("cyan", "            - From namespace:")
+        msg("cyan", "            - {} namespace:".format(direction))
         if entry_from.namespace_selector.match_expressions:
             msg("nocolor", "                {}".format(pprint.pformat(
                 entry_from.namespace_selector.match_expressions)))
@@ -150,7 +688,7 @@ def show_ingress_entry_from(entry_from, add_new_line):
                 msg("nocolor", "                label: {}={}".format(key, value))
 
     if entry_from.pod_selector:
-        msg("cyan", "            - From pod_selector:")
+        msg("cyan", "            - {} pod_selector:".format(direction))
         if entry_from.pod_selector.match_expressions:
             msg("nocolor", "                {}".format(pprint.pformat(
                 entry_from.pod_selector.match_expressions)))
@@ -159,13 +697,23 @@ def show_ingress_entry_from(entry_from, add_new_line):
                 msg("nocolor", "                label: {}={}".format(key, value))
 
     if entry_from.ip_block:
-        msg("cyan", "            - From ip_block:")
+        msg("cyan", "            - {} ip_block:".format(direction))
+        # Show the policy as it is, plus the normalized networks when
+        # they differ (e.g. host bits set or repeated excepts)
+        _, cidr, excepts = normalize_ip_block(entry_from.ip_block)
         if entry_from.ip_block._except:
             msg("nocolor", "                except: {}".format(pprint.pformat(
                 entry_from.ip_block._except)))
+            excepts = [str(i) for i in excepts]
+            if excepts != list(entry_from.ip_block._except):
+                msg("nocolor", "                except (normalized): {}".format(
+                    ', '.join(excepts)))
         if entry_from.ip_block.cidr:
             msg("nocolor", "                cidr: {}".format(pprint.pformat(
                 entry_from.ip_block.cidr)))
+            if str(cidr) != entry_from.ip_block.cidr:
+                msg("nocolor", "                cidr (normalized): {}".format(
+                    cidr))
 
 
 ##############################################################################
@@ -182,7 +730,7 @@ def show_networkpolicy_ingress(ingress):
             if ingress_entry._from:
                 for idx, entry_from in enumerate(ingress_entry._from):
                     add_new_line = True if idx < 1 else False
-                    show_ingress_entry_from(entry_from, add_new_line)
+                    show_networkpolicy_peer(entry_from, add_new_line)
             else:
                 msg("nocolor", "Accept traffic from any source")
     else:
@@ -190,13 +738,1013 @@ def show_networkpolicy_ingress(ingress):
 
 
 ##############################################################################
-# Main function
+# Show egress traffic for the network policy
 ##############################################################################
-def main():
-    requests.packages.urllib3.disable_warnings()
+def show_networkpolicy_egress(egress):
+    # If egress is None, all traffic is denied
+    # If egress.to is None, accept traffic to any destination
+    if egress:
+        for egress_entry in egress:
+            msg("cyan", "      - Dest ports:", end='')
+            show_networkpolicy_dest_ports(egress_entry)
+            msg("cyan", "          Dest traffic: ", end='')
+            if egress_entry.to:
+                for idx, entry_to in enumerate(egress_entry.to):
+                    add_new_line = True if idx < 1 else False
+                    show_networkpolicy_peer(entry_to, add_new_line,
+                                            direction='To')
+            else:
+                msg("nocolor", "Accept traffic to any destination")
+    else:
+        msg("nocolor", "      No traffic allowed. Deny all ports")
 
-    k8s = K8s()
-    namespace = k8s.get_active_context_namespace()
+
+##############################################################################
+# Return the traffic directions a network policy applies to
+##############################################################################
+def policy_types(spec):
+    """
+    Return network policy types. If policyTypes is not set, Ingress is
+    always included and Egress only if the policy has egress rules
+    """
+    if spec.policy_types:
+        return list(spec.policy_types)
+    return ['Ingress', 'Egress'] if spec.egress else ['Ingress']
+
+
+##############################################################################
+# Network policy rules normalization
+##############################################################################
+# Canonical empty label selector: matches everything
+EMPTY_SELECTOR = ((), ())
+# Canonical peer matching any pod in any namespace. It only allows traffic
+# from inside the cluster, it is not "any source"
+ANY_POD_PEER = ('pods', EMPTY_SELECTOR, EMPTY_SELECTOR)
+
+
+def normalize_selector(selector):
+    """
+    Return a hashable canonical form for a label selector:
+        (sorted match_labels items, sorted match_expressions)
+    Return None if selector is None
+    """
+    if selector is None:
+        return None
+    labels = tuple(sorted((selector.match_labels or {}).items()))
+    expressions = tuple(sorted(
+        (expr.key, expr.operator, tuple(sorted(expr.values or [])))
+        for expr in selector.match_expressions or []))
+    return labels, expressions
+
+
+def normalize_ports(ports):
+    """
+    Return a hashable canonical form for a rule ports list:
+        frozenset of (protocol, port, end_port)
+    Return None if the rule applies to all ports
+    """
+    if not ports:
+        return None
+    return frozenset((port.protocol or 'TCP',
+                      port.port,
+                      getattr(port, 'end_port', None))
+                     for port in ports)
+
+
+def parse_network(cidr):
+    """
+    Return an ipaddress network for cidr, or cidr unchanged if it is invalid
+    """
+    try:
+        return ipaddress.ip_network(cidr, strict=False)
+    except (TypeError, ValueError):
+        return cidr
+
+
+def network_sort_key(network):
+    if isinstance(network, str):
+        return (0, 0, 0, network)
+    return (network.version, int(network.network_address),
+            network.prefixlen, '')
+
+
+def normalize_ip_block(ip_block):
+    """
+    Return canonical form for an ip_block:
+        ('ipblock', network, sorted except networks)
+    """
+    excepts = sorted({parse_network(i) for i in ip_block._except or []},
+                     key=network_sort_key)
+    return 'ipblock', parse_network(ip_block.cidr), tuple(excepts)
+
+
+def normalize_peer(peer):
+    """
+    Return a hashable canonical form for an ingress from entry:
+        ('ipblock', network, excepts) or
+        ('pods', namespace selector, pod selector)
+    A None namespace selector means the policy namespace.
+    """
+    if peer.ip_block:
+        return normalize_ip_block(peer.ip_block)
+    pod_selector = normalize_selector(peer.pod_selector) or EMPTY_SELECTOR
+    return 'pods', normalize_selector(peer.namespace_selector), pod_selector
+
+
+def is_any_source(peers):
+    """
+    Check if the canonical peers accept traffic from any source: ip_blocks
+    0.0.0.0/0 and ::/0, both without except
+    """
+    versions = {peer[1].version for peer in peers
+                if peer[0] == 'ipblock' and not isinstance(peer[1], str) and
+                peer[1].prefixlen == 0 and not peer[2]}
+    return versions == {4, 6}
+
+
+def format_selector(selector):
+    if selector is None:
+        return 'policy namespace'
+    if selector == EMPTY_SELECTOR:
+        return 'all'
+    labels, expressions = selector
+    items = ['{}={}'.format(key, value) for key, value in labels]
+    items += ['{} {} ({})'.format(key, operator, ','.join(values))
+              for key, operator, values in expressions]
+    return ', '.join(items)
+
+
+def format_peer(peer):
+    if peer[0] == 'ipblock':
+        text = 'cidr {}'.format(peer[1])
+        if peer[2]:
+            text += ' except {}'.format(', '.join(str(i) for i in peer[2]))
+        return text
+    return 'namespace [{}] pods [{}]'.format(format_selector(peer[1]),
+                                             format_selector(peer[2]))
+
+
+def format_ports(ports):
+    if ports is None:
+        return 'all ports'
+    items = list()
+    for protocol, port, end_port in sorted(ports, key=str):
+        port = 'all' if port is None else port
+        if end_port:
+            port = '{}-{}'.format(port, end_port)
+        items.append('{}/{}'.format(port, protocol))
+    return ' '.join(items)
+
+
+class IngressRule():
+    """
+    Canonical form of one ingress rule of a network policy
+    """
+    def __init__(self, netpol, index, rule):
+        self.namespace = netpol.metadata.namespace
+        self.policy = netpol.metadata.name
+        self.index = index
+        self.target = normalize_selector(netpol.spec.pod_selector) or \
+            EMPTY_SELECTOR
+        self.ports = normalize_ports(rule.ports)
+        # None means any source
+        self.peers = None
+        if rule._from:
+            self.peers = frozenset(normalize_peer(i) for i in rule._from)
+            if is_any_source(self.peers):
+                self.peers = None
+
+    @property
+    def key(self):
+        return self.namespace, self.target, self.ports, self.peers
+
+    def __str__(self):
+        return '{}/{} ingress[{}]'.format(self.namespace, self.policy,
+                                          self.index)
+
+
+def create_ingress_rules(netpols):
+    """
+    Return a list with IngressRule for all ingress rules of the policies
+    """
+    return [IngressRule(netpol, idx, rule)
+            for netpol in netpols
+            for idx, rule in enumerate(netpol.spec.ingress or [])]
+
+
+##############################################################################
+# Network policy rules redundancy analysis
+##############################################################################
+def port_covers(port, other):
+    """
+    Check if canonical port covers canonical other port
+    """
+    protocol, number, end = port
+    other_protocol, other_number, other_end = other
+    if protocol != other_protocol:
+        return False
+    if number is None or port == other:
+        return True
+    if not isinstance(number, int) or not isinstance(other_number, int):
+        return number == other_number and not other_end
+    return number <= other_number and \
+        (end or number) >= (other_end or other_number)
+
+
+def ports_cover(ports, other):
+    """
+    Check if canonical ports list covers all other ports
+    """
+    if ports is None:
+        return True
+    if other is None:
+        return False
+    return all(any(port_covers(i, j) for i in ports) for j in other)
+
+
+def ip_block_covers(peer, other):
+    """
+    Check if canonical ip_block peer covers the other ip_block: the cidr
+    contains the other one and each except overlapping the other cidr is
+    also excluded by the other
+    """
+    _, cidr, excepts = peer
+    _, other_cidr, other_excepts = other
+    if cidr.version != other_cidr.version or \
+       not other_cidr.subnet_of(cidr):
+        return False
+    for exc in excepts:
+        if isinstance(exc, str):
+            return False
+        if exc.version != other_cidr.version or \
+           not exc.overlaps(other_cidr):
+            continue
+        if not any(not isinstance(i, str) and i.version == exc.version and
+                   exc.subnet_of(i) for i in other_excepts):
+            return False
+    return True
+
+
+def cidr_key(network, prefixlen=None):
+    """
+    Return (version, network address, prefixlen) for the network, or for
+    its supernet with prefixlen if informed
+    """
+    if prefixlen is None:
+        prefixlen = network.prefixlen
+    host_bits = network.max_prefixlen - prefixlen
+    address = int(network.network_address) >> host_bits << host_bits
+    return network.version, address, prefixlen
+
+
+class CidrIndex():
+    """
+    Index of ip_block peers by cidr.
+    covering() looks up each supernet of the given cidr, i.e. at most 33
+    (IPv4) or 129 (IPv6) lookups, plus the entries found.
+    """
+    def __init__(self, entries):
+        """
+        Arguments:
+            entries (list): list of (peer, value) with ip_block peers
+        """
+        self._index = collections.defaultdict(list)
+        for peer, value in entries:
+            if not isinstance(peer[1], str):
+                self._index[cidr_key(peer[1])].append((peer, value))
+
+    def covering(self, peer):
+        """
+        Yield (peer, value) for entries whose ip_block covers peer
+        """
+        cidr = peer[1]
+        if isinstance(cidr, str):
+            return
+        for prefixlen in range(cidr.prefixlen, -1, -1):
+            for item_peer, value in self._index.get(cidr_key(cidr, prefixlen),
+                                                    ()):
+                if ip_block_covers(item_peer, peer):
+                    yield item_peer, value
+
+
+def analyze_ingress_rules(rules):
+    """
+    Find duplicate, shadowed and allow-all ingress rules.
+
+    Rules are compared when they belong to the same namespace and target the
+    same canonical pod selector. A rule is shadowed when another rule allows
+    at least the same ports from at least the same peers. Pod peers are
+    covered by an identical peer or by an empty selector; label subsets are
+    not evaluated, so shadowing is only reported when it is certain. Pod
+    peers never cover ip_blocks and ip_blocks of one IP version never cover
+    the other version. Only rules without peers, or with ip_blocks 0.0.0.0/0
+    and ::/0 without except, accept traffic from any source. Rules covering
+    each other are equivalent and reported as duplicate, not as shadowed.
+
+    Return:
+        dict with keys:
+            duplicate: list of lists of rules with the same canonical form
+                       or covering each other
+            shadowed:  list of (rules, strictly wider shadowing rules)
+            allow_all: list of rules accepting traffic from any source
+    """
+    report = {'duplicate': list(), 'shadowed': list(), 'allow_all': list()}
+
+    # Group rules by canonical form
+    unique = collections.defaultdict(list)
+    for rule in rules:
+        unique[rule.key].append(rule)
+        if rule.peers is None:
+            report['allow_all'].append(rule)
+
+    # Group canonical forms by namespace and target pods
+    groups = collections.defaultdict(list)
+    for key in unique:
+        groups[key[:2]].append(key)
+
+    for keys in groups.values():
+        shadowing = find_shadowing_rules(keys)
+        for same in equivalent_rules(keys, shadowing):
+            same_rules = [rule for key in same for rule in unique[key]]
+            if len(same_rules) > 1:
+                report['duplicate'].append(same_rules)
+            wider = set().union(*(shadowing[key] for key in same)) - set(same)
+            if wider:
+                report['shadowed'].append(
+                    (same_rules,
+                     sorted((rule for key in wider for rule in unique[key]),
+                            key=str)))
+
+    return report
+
+
+def find_shadowing_rules(keys):
+    """
+    Return dict with the canonical rules covering each canonical rule.
+    All keys have the same namespace and target pods.
+    """
+    shadowing = {key: set() for key in keys}
+    if len(keys) < 2:
+        return shadowing
+    any_source = set()
+    by_peer = collections.defaultdict(set)
+    ip_blocks = list()
+    for key in keys:
+        peers = key[3]
+        if peers is None:
+            any_source.add(key)
+            continue
+        for peer in peers:
+            by_peer[peer].add(key)
+            if peer[0] == 'ipblock':
+                ip_blocks.append((peer, key))
+    cidr_index = CidrIndex(ip_blocks)
+
+    def covering(peer):
+        found = set(any_source) | by_peer.get(peer, set())
+        if peer[0] == 'ipblock':
+            found.update(key for _, key in cidr_index.covering(peer))
+        else:
+            # Empty pod selector on the same namespaces, same pod
+            # selector on all namespaces and all pods
+            found |= by_peer.get(('pods', peer[1], EMPTY_SELECTOR), set())
+            found |= by_peer.get(('pods', EMPTY_SELECTOR, peer[2]), set())
+            found |= by_peer.get(ANY_POD_PEER, set())
+        return found
+
+    for key in keys:
+        peers = key[3]
+        if peers is None:
+            candidates = set(any_source)
+        else:
+            candidates = None
+            for peer in peers:
+                found = covering(peer)
+                candidates = found if candidates is None \
+                    else candidates & found
+                if not candidates:
+                    break
+        candidates.discard(key)
+        shadowing[key] = {other for other in candidates
+                          if ports_cover(other[2], key[2])}
+    return shadowing
+
+
+def equivalent_rules(keys, shadowing):
+    """
+    Return lists of canonical rules covering each other, in keys order.
+    Rules not equivalent to any other are returned alone.
+    """
+    order = {key: pos for pos, key in enumerate(keys)}
+    classes = dict()
+    for key in keys:
+        if key in classes:
+            continue
+        same = [key]
+        classes[key] = same
+        pending = [key]
+        while pending:
+            current = pending.pop()
+            for other in shadowing[current]:
+                if other not in classes and current in shadowing[other]:
+                    classes[other] = same
+                    same.append(other)
+                    pending.append(other)
+        same.sort(key=order.get)
+    return [same for key, same in classes.items() if same[0] == key]
+
+
+def show_ingress_rules_analysis(report):
+    msg("cyan", "Duplicate rules: {}".format(len(report['duplicate'])))
+    for same in report['duplicate']:
+        msg("yellow", "  - {}".format(', '.join(str(i) for i in same)))
+    msg("cyan", "Shadowed rules: {}".format(len(report['shadowed'])))
+    for shadowed, shadowing in report['shadowed']:
+        msg("yellow", "  - {}".format(', '.join(str(i) for i in shadowed)))
+        msg("nocolor", "      ports: {}".format(format_ports(shadowed[0].ports)))
+        for peer in sorted(shadowed[0].peers or [], key=str):
+            msg("nocolor", "      from: {}".format(format_peer(peer)))
+        msg("nocolor", "      shadowed by: {}".format(
+            ', '.join(str(i) for i in shadowing)))
+    msg("cyan", "Allow-all rules: {}".format(len(report['allow_all'])))
+    for rule in report['allow_all']:
+        msg("yellow", "  - {}".format(rule), end='')
+        msg("nocolor", " ({})".format(format_ports(rule.ports)))
+
+
+##############################################################################
+# Network policy to pods evaluation
+##############################################################################
+def parse_address(address):
+    """
+    Return an ipaddress address for address, or None if it is invalid
+    """
+    try:
+        return ipaddress.ip_address(address)
+    except (TypeError, ValueError):
+        return None
+
+
+def pod_ip(pod):
+    return pod.status.pod_ip if pod.status else None
+
+
+def ip_block_matches(peer, address):
+    """
+    Check if the address is inside the canonical ip_block peer cidr and
+    outside its excepts
+    """
+    if address is None or address.version != peer[1].version:
+        return False
+    return address in peer[1] and \
+        not any(not isinstance(i, str) and i.version == address.version and
+                address in i for i in peer[2])
+
+
+def selector_matches(selector, labels):
+    """
+    Check if the canonical label selector matches the labels
+    """
+    match_labels, expressions = selector
+    for key, value in match_labels:
+        if labels.get(key) != value:
+            return False
+    for key, operator, values in expressions:
+        if operator == 'In':
+            matches = key in labels and labels[key] in values
+        elif operator == 'NotIn':
+            matches = key not in labels or labels[key] not in values
+        elif operator == 'Exists':
+            matches = key in labels
+        elif operator == 'DoesNotExist':
+            matches = key not in labels
+        else:
+            matches = False
+        if not matches:
+            return False
+    return True
+
+
+class CompiledPolicy():
+    """
+    Canonical form of a network policy used by PolicyMatcher
+    """
+    def __init__(self, netpol):
+        spec = netpol.spec
+        self.key = (netpol.metadata.namespace, netpol.metadata.name)
+        self.namespace = netpol.metadata.namespace
+        self.target = normalize_selector(spec.pod_selector) or EMPTY_SELECTOR
+        self.types = frozenset(policy_types(spec))
+        # rules by direction: list of (ports, peers); peers None is any peer
+        self.rules = dict()
+        for direction, rules, attr in (('Ingress', spec.ingress, '_from'),
+                                       ('Egress', spec.egress, 'to')):
+            self.rules[direction] = list()
+            for rule in rules or []:
+                peers = getattr(rule, attr)
+                if peers:
+                    peers = tuple(normalize_peer(i) for i in peers)
+                    if is_any_source(peers):
+                        peers = None
+                else:
+                    peers = None
+                self.rules[direction].append(
+                    (normalize_ports(rule.ports), peers))
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledPolicy) and \
+            (self.key, self.target, self.types, self.rules) == \
+            (other.key, other.target, other.types, other.rules)
+
+    def match_peers(self):
+        """
+        Yield (peer id, peer) for the peers of the policy matched against
+        pods: pod peers and valid ip_block peers.
+        peer id is (policy key, direction, rule index, peer index)
+        """
+        for direction, rules in self.rules.items():
+            for rule_idx, (_, peers) in enumerate(rules):
+                for peer_idx, peer in enumerate(peers or []):
+                    if peer[0] == 'pods' or \
+                       not isinstance(peer[1], str):
+                        yield (self.key, direction, rule_idx, peer_idx), peer
+
+
+class PolicyMatcher():
+    """
+    Keep which pods each network policy selects (targets) and which pods
+    match each policy peer, for ingress and egress. ip_block peers match
+    the pods whose IP is inside the cidr and outside the excepts.
+
+    Results are updated incrementally: changing one policy re-evaluates only
+    that policy, changing pod labels re-evaluates only that pod and changing
+    namespace labels re-evaluates only the peers selecting namespaces.
+    Changes come from watch events (apply_event) or from a diff between
+    snapshots (apply_snapshot).
+
+    Mutating methods return the set of pods whose evaluation may have
+    changed.
+    """
+    def __init__(self):
+        self.namespaces = dict()
+        self.pods = dict()
+        self.pod_ips = dict()
+        self.policies = dict()
+        self.ns_pods = collections.defaultdict(set)
+        self.ns_policies = collections.defaultdict(set)
+        # policy key -> pods selected by policy pod selector
+        self.targets = dict()
+        # pod key -> policies selecting the pod
+        self.pod_policies = collections.defaultdict(set)
+        # peer id -> (policy namespace, peer) and peer id -> matched pods
+        self.peers = dict()
+        self.peer_pods = dict()
+        # peer ids by policy namespace (peers without namespace selector),
+        # peers with namespace selector and ip_block peers
+        self.ns_local_peers = collections.defaultdict(set)
+        self.ns_selector_peers = set()
+        self.ip_block_peers = set()
+
+    def _peer_namespace_matches(self, peer_id, namespace):
+        policy_ns, peer = self.peers[peer_id]
+        if peer[1] is None:
+            return namespace == policy_ns
+        return namespace in self.namespaces and \
+            selector_matches(peer[1], self.namespaces[namespace])
+
+    def _peer_matches(self, peer_id, pod_key):
+        peer = self.peers[peer_id][1]
+        if peer[0] == 'ipblock':
+            return ip_block_matches(peer, self.pod_ips.get(pod_key))
+        return self._peer_namespace_matches(peer_id, pod_key[0]) and \
+            selector_matches(peer[2], self.pods[pod_key])
+
+    def _peer_owner_targets(self, peer_id):
+        return self.targets.get(peer_id[0], set())
+
+    ##########################################################################
+    # Network policies
+    ##########################################################################
+    def set_policy(self, netpol):
+        compiled = CompiledPolicy(netpol)
+        if self.policies.get(compiled.key) == compiled:
+            return set()
+        changed = self.delete_policy(compiled.key)
+        self.policies[compiled.key] = compiled
+        self.ns_policies[compiled.namespace].add(compiled.key)
+
+        targets = {pod for pod in self.ns_pods[compiled.namespace]
+                   if selector_matches(compiled.target, self.pods[pod])}
+        self.targets[compiled.key] = targets
+        for pod in targets:
+            self.pod_policies[pod].add(compiled.key)
+
+        for peer_id, peer in compiled.match_peers():
+            self.peers[peer_id] = (compiled.namespace, peer)
+            if peer[0] == 'ipblock':
+                self.ip_block_peers.add(peer_id)
+                self.peer_pods[peer_id] = {
+                    pod for pod, ip in self.pod_ips.items()
+                    if ip_block_matches(peer, ip)}
+                continue
+            if peer[1] is None:
+                self.ns_local_peers[compiled.namespace].add(peer_id)
+                namespaces = [compiled.namespace]
+            else:
+                self.ns_selector_peers.add(peer_id)
+                namespaces = [ns for ns in self.namespaces
+                              if selector_matches(peer[1],
+                                                  self.namespaces[ns])]
+            self.peer_pods[peer_id] = {
+                pod for ns in namespaces for pod in self.ns_pods[ns]
+                if selector_matches(peer[2], self.pods[pod])}
+        return changed | targets
+
+    def delete_policy(self, key):
+        compiled = self.policies.pop(key, None)
+        if compiled is None:
+            return set()
+        self.ns_policies[compiled.namespace].discard(key)
+        targets = self.targets.pop(key)
+        for pod in targets:
+            self.pod_policies[pod].discard(key)
+        for peer_id, _ in compiled.match_peers():
+            del self.peers[peer_id]
+            del self.peer_pods[peer_id]
+            self.ns_local_peers[compiled.namespace].discard(peer_id)
+            self.ns_selector_peers.discard(peer_id)
+            self.ip_block_peers.discard(peer_id)
+        return targets
+
+    ##########################################################################
+    # Pods
+    ##########################################################################
+    def set_pod(self, namespace, name, labels, pod_ip=None):
+        key = (namespace, name)
+        labels = dict(labels or {})
+        pod_ip = parse_address(pod_ip)
+        if key in self.pods and self.pods[key] == labels and \
+           self.pod_ips.get(key) == pod_ip:
+            return set()
+        self.pods[key] = labels
+        self.ns_pods[namespace].add(key)
+        if pod_ip is None:
+            self.pod_ips.pop(key, None)
+        else:
+            self.pod_ips[key] = pod_ip
+        changed = {key}
+
+        for policy_key in self.ns_policies[namespace]:
+            selected = selector_matches(self.policies[policy_key].target,
+                                        labels)
+            if selected:
+                self.targets[policy_key].add(key)
+                self.pod_policies[key].add(policy_key)
+            else:
+                self.targets[policy_key].discard(key)
+                self.pod_policies[key].discard(policy_key)
+
+        for peer_id in self._pod_candidate_peers(namespace):
+            matched = self._peer_matches(peer_id, key)
+            if matched != (key in self.peer_pods[peer_id]):
+                if matched:
+                    self.peer_pods[peer_id].add(key)
+                else:
+                    self.peer_pods[peer_id].discard(key)
+                changed |= self._peer_owner_targets(peer_id)
+        return changed
+
+    def delete_pod(self, namespace, name):
+        key = (namespace, name)
+        if self.pods.pop(key, None) is None:
+            return set()
+        self.pod_ips.pop(key, None)
+        self.ns_pods[namespace].discard(key)
+        for policy_key in self.pod_policies.pop(key, set()):
+            self.targets[policy_key].discard(key)
+        changed = {key}
+        for peer_id in self._pod_candidate_peers(namespace):
+            if key in self.peer_pods[peer_id]:
+                self.peer_pods[peer_id].discard(key)
+                changed |= self._peer_owner_targets(peer_id)
+        return changed
+
+    def _pod_candidate_peers(self, namespace):
+        return self.ns_local_peers[namespace] | self.ns_selector_peers | \
+            self.ip_block_peers
+
+    ##########################################################################
+    # Namespaces
+    ##########################################################################
+    def set_namespace(self, name, labels):
+        labels = dict(labels or {})
+        if self.namespaces.get(name) == labels:
+            return set()
+        old = {peer_id for peer_id in self.ns_selector_peers
+               if self._peer_namespace_matches(peer_id, name)}
+        self.namespaces[name] = labels
+        return self._update_namespace_peers(name, old)
+
+    def delete_namespace(self, name):
+        if name not in self.namespaces:
+            return set()
+        old = {peer_id for peer_id in self.ns_selector_peers
+               if self._peer_namespace_matches(peer_id, name)}
+        del self.namespaces[name]
+        return self._update_namespace_peers(name, old)
+
+    def _update_namespace_peers(self, name, old):
+        changed = set()
+        for peer_id in self.ns_selector_peers:
+            matched = self._peer_namespace_matches(peer_id, name)
+            if matched == (peer_id in old):
+                continue
+            selector = self.peers[peer_id][1][2]
+            pods = {pod for pod in self.ns_pods[name]
+                    if selector_matches(selector, self.pods[pod])}
+            if not pods:
+                continue
+            if matched:
+                self.peer_pods[peer_id] |= pods
+            else:
+                self.peer_pods[peer_id] -= pods
+            changed |= self._peer_owner_targets(peer_id)
+        return changed
+
+    ##########################################################################
+    # Watch events and snapshots
+    ##########################################################################
+    def apply_event(self, kind, event):
+        """
+        Apply a kubernetes watch event
+
+        Arguments:
+            kind   (str): Namespace, Pod or NetworkPolicy
+            event (dict): watch event with 'type' and 'object'
+        """
+        obj = event['object']
+        deleted = event['type'] == 'DELETED'
+        if kind == 'NetworkPolicy':
+            if deleted:
+                return self.delete_policy((obj.metadata.namespace,
+                                           obj.metadata.name))
+            return self.set_policy(obj)
+        if kind == 'Pod':
+            if deleted:
+                return self.delete_pod(obj.metadata.namespace,
+                                       obj.metadata.name)
+            return self.set_pod(obj.metadata.namespace, obj.metadata.name,
+                                obj.metadata.labels, pod_ip(obj))
+        if kind == 'Namespace':
+            if deleted:
+                return self.delete_namespace(obj.metadata.name)
+            return self.set_namespace(obj.metadata.name, obj.metadata.labels)
+        raise ValueError("Invalid kind: {}".format(kind))
+
+    def apply_snapshot(self, namespaces, pods, netpols):
+        """
+        Apply only the differences between the current state and a snapshot
+
+        Arguments:
+            namespaces (list): namespace objects
+            pods       (list): pod objects
+            netpols    (list): network policy objects
+        """
+        changed = set()
+        names = {i.metadata.name for i in namespaces}
+        pod_keys = {(i.metadata.namespace, i.metadata.name) for i in pods}
+        policy_keys = {(i.metadata.namespace, i.metadata.name)
+                       for i in netpols}
+        for namespace in namespaces:
+            changed |= self.set_namespace(namespace.metadata.name,
+                                          namespace.metadata.labels)
+        for pod in pods:
+            changed |= self.set_pod(pod.metadata.namespace, pod.metadata.name,
+                                    pod.metadata.labels, pod_ip(pod))
+        for netpol in netpols:
+            changed |= self.set_policy(netpol)
+        for key in set(self.policies) - policy_keys:
+            changed |= self.delete_policy(key)
+        for key in set(self.pods) - pod_keys:
+            changed |= self.delete_pod(*key)
+        for name in set(self.namespaces) - names:
+            changed |= self.delete_namespace(name)
+        return {pod for pod in changed if pod in self.pods}
+
+    ##########################################################################
+    # Evaluation
+    ##########################################################################
+    def isolating_policies(self, pod_key, direction):
+        """
+        Return the policies isolating the pod for the direction
+        (Ingress or Egress). An empty list means all traffic is allowed.
+        """
+        return sorted(self._isolating_policies(pod_key, direction))
+
+    def _isolating_policies(self, pod_key, direction):
+        return [key for key in self.pod_policies.get(pod_key, ())
+                if direction in self.policies[key].types]
+
+    def allowed_peers(self, pod_key, direction):
+        """
+        Return the pods allowed as peers of the pod for the direction,
+        from the cached peer matches, or None if all pods are allowed.
+        """
+        policies = self._isolating_policies(pod_key, direction)
+        if not policies:
+            return None
+        allowed = set()
+        for policy_key in policies:
+            rules = self.policies[policy_key].rules[direction]
+            for rule_idx, (_, peers) in enumerate(rules):
+                if peers is None:
+                    return None
+                for peer_idx, _ in enumerate(peers):
+                    allowed |= self.peer_pods.get(
+                        (policy_key, direction, rule_idx, peer_idx), set())
+        return allowed
+
+    def allowed_ip_blocks(self, pod_key, direction):
+        """
+        Return the ip_block peers allowed for the pod for the direction
+        """
+        ip_blocks = set()
+        for policy_key in self._isolating_policies(pod_key, direction):
+            for _, peers in self.policies[policy_key].rules[direction]:
+                ip_blocks.update(peer for peer in peers or []
+                                 if peer[0] == 'ipblock')
+        return sorted(ip_blocks, key=lambda i: (network_sort_key(i[1]),
+                                                 format_peer(i)))
+
+    def allowed(self, pod_key, peer_key, direction, *, port=None,
+                protocol='TCP'):
+        """
+        Check if pod accepts traffic from peer pod (Ingress) or sends
+        traffic to peer pod (Egress), on the port if informed
+        """
+        policies = self._isolating_policies(pod_key, direction)
+        if not policies:
+            return True
+        for policy_key in policies:
+            rules = self.policies[policy_key].rules[direction]
+            for rule_idx, (ports, peers) in enumerate(rules):
+                if port is not None and \
+                   not ports_cover(ports, {(protocol, port, None)}):
+                    continue
+                if peers is None:
+                    return True
+                for peer_idx, _ in enumerate(peers):
+                    peer_id = (policy_key, direction, rule_idx, peer_idx)
+                    if peer_key in self.peer_pods.get(peer_id, ()):
+                        return True
+        return False
+
+    def connection_allowed(self, src_key, dst_key, *, port=None,
+                           protocol='TCP'):
+        """
+        Check if src pod can connect to dst pod: src egress and dst ingress
+        """
+        return self.allowed(src_key, dst_key, 'Egress', port=port,
+                            protocol=protocol) and \
+            self.allowed(dst_key, src_key, 'Ingress', port=port,
+                         protocol=protocol)
+
+
+def show_pod_evaluation(matcher, pod_key):
+    msg("green", "  - {}".format(pod_key[1]))
+    for direction in ('Ingress', 'Egress'):
+        policies = matcher.isolating_policies(pod_key, direction)
+        msg("cyan", "      {}: ".format(direction), end='')
+        if not policies:
+            msg("nocolor", "not isolated, all traffic allowed")
+            continue
+        msg("nocolor", "isolated by {}".format(
+            ', '.join(name for _, name in policies)))
+        peers = matcher.allowed_peers(pod_key, direction)
+        if peers is None:
+            num_peers = len(matcher.pods) - 1
+        else:
+            num_peers = len(peers - {pod_key})
+        msg("nocolor", "        allowed {} pods: {}/{}".format(
+            'from' if direction == 'Ingress' else 'to',
+            num_peers, len(matcher.pods) - 1))
+        for peer in matcher.allowed_ip_blocks(pod_key, direction):
+            msg("nocolor", "        allowed {} {}".format(
+                'from' if direction == 'Ingress' else 'to',
+                format_peer(peer)))
+
+
+##############################################################################
+# Evaluate network policies for the pods of a kubeconfig context namespace
+##############################################################################
+def load_policy_snapshot(k8s, matcher):
+    """
+    Load namespaces, pods and network policies into the matcher, applying
+    only the differences from its current state
+
+    Return:
+        changed pods, dict with the resource version of each kind list
+    """
+    namespaces = k8s.list_namespaces()
+    pods = k8s.list_all_pods()
+    netpols = k8s.list_all_networkpolicy()
+    changed = matcher.apply_snapshot(namespaces.items, pods.items,
+                                     netpols.items)
+    versions = {'Namespace': namespaces.metadata.resource_version,
+                'Pod': pods.metadata.resource_version,
+                'NetworkPolicy': netpols.metadata.resource_version}
+    return changed, versions
+
+
+def start_watches(k8s, events, versions):
+    """
+    Start a watch thread per kind from the snapshot resource versions.
+    Return the threading.Event that stops them
+    """
+    stop = threading.Event()
+    for kind, resource_version in versions.items():
+        threading.Thread(target=k8s.watch,
+                         args=(kind, events, resource_version, stop),
+                         daemon=True).start()
+    return stop
+
+
+def watch_policy_changes(k8s, matcher, namespace, versions):
+    """
+    Update the matcher from watch events and show the pods of the
+    namespace whose evaluation changed.
+
+    Arguments:
+        versions (dict): resource versions of the snapshot loaded into
+                         the matcher, where the watches start from
+    """
+    events = queue.Queue()
+    stop = start_watches(k8s, events, versions)
+
+    msg("blue", "Watching for changes...")
+    while True:
+        event_stop, kind, event = events.get()
+        # Events from watches stopped by a resync are older than the
+        # snapshot loaded by the resync
+        if event_stop is not stop:
+            continue
+        if kind == 'RESYNC':
+            stop.set()
+            changed, versions = load_policy_snapshot(k8s, matcher)
+            stop = start_watches(k8s, events, versions)
+            description = 'resync'
+        else:
+            changed = matcher.apply_event(kind, event)
+            description = '{} {} {}'.format(event['type'], kind,
+                                            event['object'].metadata.name)
+        changed = sorted(pod for pod in changed if pod[0] == namespace)
+        log.debug("%s: %s pods changed", description, len(changed))
+        if not changed:
+            continue
+        msg("yellow", description)
+        for pod_key in changed:
+            show_pod_evaluation(matcher, pod_key)
+
+
+def evaluate_context_networkpolicy(context=None, *, request_timeout=None,
+                                   watch=False):
+    k8s = K8s(context, request_timeout=request_timeout)
+    namespace = k8s.active_namespace
+    matcher = PolicyMatcher()
+    _, versions = load_policy_snapshot(k8s, matcher)
+
+    msg("blue", "Namespace: {}".format(namespace))
+    pods = sorted(matcher.ns_pods[namespace])
+    if not pods:
+        msg("red", "  There is no pod on this namespace")
+    for pod_key in pods:
+        show_pod_evaluation(matcher, pod_key)
+
+    if watch:
+        try:
+            watch_policy_changes(k8s, matcher, namespace, versions)
+        except KeyboardInterrupt:
+            pass
+
+
+##############################################################################
+# Analyze all network policies for a kubeconfig context
+##############################################################################
+def analyze_context_networkpolicy(context=None, *, request_timeout=None):
+    k8s = K8s(context, request_timeout=request_timeout)
+    netpols = k8s.list_all_networkpolicy()
+    rules = create_ingress_rules(netpols.items)
+    msg("blue", "Analyzed {} ingress rules from {} network policies".format(
+        len(rules), len(netpols.items)))
+    show_ingress_rules_analysis(analyze_ingress_rules(rules))
+
+
+##############################################################################
+# Show network policy for a kubeconfig context namespace
+##############################################################################
+def show_context_networkpolicy(context=None, *, request_timeout=None):
+    k8s = K8s(context, request_timeout=request_timeout)
+    namespace = k8s.active_namespace
     msg("blue", "Namespace: {}".format(namespace))
 
     netpols = k8s.list_networkpolicy(namespace)
@@ -210,7 +1758,63 @@ def main():
             msg("green", "  - {}".format(netpol.metadata.name))
 #            pprint.pprint(netpol)
             show_networkpolicy_target_pods(netpol)
-            show_networkpolicy_ingress(netpol.spec.ingress)
+            types = policy_types(netpol.spec)
+            msg("cyan", "      Policy types: ", end='')
+            msg("nocolor", ", ".join(types))
+            if 'Ingress' in types:
+                msg("cyan", "      Ingress:")
+                show_networkpolicy_ingress(netpol.spec.ingress)
+            if 'Egress' in types:
+                msg("cyan", "      Egress:")
+                show_networkpolicy_egress(netpol.spec.egress)
+
+
+##############################################################################
+# Main function
+##############################################################################
+def main():
+    global log, scheduler_limits
+    args = parse_parameters()
+
+    # Configure log if --debug
+    log = setup_logging() if args.debug else logging
+    log.debug('CMD line args: %s', vars(args))
+
+    scheduler_limits = dict(qps=args.qps, burst=args.burst,
+                            max_inflight=args.max_inflight,
+                            retries=args.retries)
+    try:
+        get_scheduler()
+    except ValueError as exc:
+        msg("red", "Error: {}".format(exc), 1)
+
+    requests.packages.urllib3.disable_warnings()
+
+    if args.analyze:
+        show_func = analyze_context_networkpolicy
+    elif args.pods:
+        show_func = functools.partial(evaluate_context_networkpolicy,
+                                      watch=args.watch)
+    else:
+        show_func = show_context_networkpolicy
+
+    contexts = K8s.list_contexts() if args.all_contexts else args.contexts
+    failed = 0
+    if not contexts:
+        show_func()
+    else:
+        results = run_on_contexts(
+            contexts,
+            lambda context: show_func(context, request_timeout=args.timeout),
+            timeout=args.timeout)
+        failed = show_contexts_report(results)
+
+    for context, sched in list(schedulers.items()):
+        log.debug('Scheduler counters (%s): %s',
+                  context or 'active context', sched.stats())
+
+    if failed:
+        sys.exit(1)
 
 
 ##############################################################################
@@ -4,16 +4,49 @@
 # TODO: Remove from output pod that podname terminate with -deploy
 
 import argparse
+import calendar
+import collections
+import functools
+import heapq
+import itertools
+import os
+import random
+import io
+import re
+import shlex
 import subprocess
 import sys
+import threading
+import time
 import logging
 import json
+import math
 import pprint
 import prettytable
 
 
 KUBE_BIN = 'oc'
 
+# Max bytes read from container logs by diag (only first lines are shown)
+LOGS_LIMIT_BYTES = 65536
+
+# Request priority classes. Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# oc error messages that mean the api server asked us to slow down
+THROTTLED_RE = re.compile(r'TooManyRequests|too many requests|'
+                          r'ServiceUnavailable|'
+                          r'the server is currently unable to handle the request',
+                          re.IGNORECASE)
+log = logging
+# Request schedulers by kubeconfig context (None is the active context)
+scheduler_limits = None
+schedulers = dict()
+schedulers_lock = threading.Lock()
+# oc --request-timeout in seconds, when set
+request_timeout = None
+
 ##############################################################################
 # Parses the command line arguments
 ##############################################################################
@@ -23,7 +56,10 @@ def parse_parameters():
     Example of use:
         %s diag
         %s limit
-    ''' % (sys.argv[0], sys.argv[0])
+        %s top restarts notready -n 10
+        %s --contexts cluster1,cluster2 diag
+        %s --all-contexts image
+    ''' % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
     # Create the argparse object and define global options
     parser = argparse.ArgumentParser(description='podinfo',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -32,6 +68,8 @@ def parse_parameters():
                         action='store_true',
                         dest='debug',
                         help='debug flag')
+    add_scheduler_parameters(parser)
+    add_context_parameters(parser)
     # Add subcommands options
     subparsers = parser.add_subparsers(title='Commands', dest='command')
     # diag
@@ -58,13 +96,211 @@ def parse_parameters():
     ports_parser = subparsers.add_parser('ports',
                                          help='Show pod ports')
     ports_parser.set_defaults(func=cmd_ports)
+    # top
+    top_parser = subparsers.add_parser('top',
+                                       help='Show the top pods by metric')
+    top_parser.add_argument('metrics',
+                            nargs='+',
+                            choices=sorted(TOP_METRICS),
+                            help='restarts: most restarts, '
+                                 'age: oldest pods, '
+                                 'notready: oldest not ready pods, '
+                                 'nolimits: containers without limits '
+                                 'with most restarts')
+    top_parser.add_argument('-n',
+                            type=int,
+                            default=20,
+                            dest='size',
+                            help='number of entries to show '
+                                 '(default: %(default)s)')
+    top_parser.set_defaults(func=cmd_top, stream_pods=True)
 
     # If there is no parameter, print help
     if len(sys.argv) < 2:
         parser.print_help()
         sys.exit(0)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.command == 'top':
+        if args.size < 1:
+            parser.error('-n must be greater than zero')
+        args.func = functools.partial(cmd_top, metrics=args.metrics,
+                                      size=args.size)
+    return args
+
+
+def add_scheduler_parameters(parser):
+    """
+    Add the api request scheduler options to an argparse parser.
+    Defaults are read from the environment, so the limits can be set once
+    for all plugins. argparse converts them with type, so an invalid value
+    is reported as an usage error.
+    """
+    group = parser.add_argument_group('API request limits')
+    group.add_argument('--qps',
+                       type=float,
+                       default=os.environ.get('KUBECTL_PLUGINS_QPS', '5'),
+                       help='max requests per second sent to the api server '
+                            '(env KUBECTL_PLUGINS_QPS, default: %(default)s)')
+    group.add_argument('--burst',
+                       type=int,
+                       default=os.environ.get('KUBECTL_PLUGINS_BURST', '10'),
+                       help='max burst of requests above qps '
+                            '(env KUBECTL_PLUGINS_BURST, default: %(default)s)')
+    group.add_argument('--max-inflight',
+                       type=int,
+                       dest='max_inflight',
+                       default=os.environ.get('KUBECTL_PLUGINS_MAX_INFLIGHT', '4'),
+                       help='max requests running at the same time '
+                            '(env KUBECTL_PLUGINS_MAX_INFLIGHT, default: %(default)s)')
+    group.add_argument('--retries',
+                       type=int,
+                       default=os.environ.get('KUBECTL_PLUGINS_RETRIES', '3'),
+                       help='max retries for throttled requests '
+                            '(env KUBECTL_PLUGINS_RETRIES, default: %(default)s)')
+
+
+def add_context_parameters(parser):
+    """
+    Add the multi-cluster options to an argparse parser
+    """
+    group = parser.add_argument_group('Multi-cluster')
+    contexts = group.add_mutually_exclusive_group()
+    contexts.add_argument('--contexts',
+                          type=lambda value: [i for i in value.split(',') if i],
+                          dest='contexts',
+                          metavar='CTX1,CTX2',
+                          help='kubeconfig contexts to query concurrently')
+    contexts.add_argument('--all-contexts',
+                          action='store_true',
+                          dest='all_contexts',
+                          help='query all kubeconfig contexts concurrently')
+    group.add_argument('--timeout',
+                       type=float,
+                       default=60,
+                       help='max seconds to wait for each cluster '
+                            '(default: %(default)s)')
+
+
+def get_scheduler(context=None):
+    """
+    Return the request scheduler for the context, creating it on first use.
+    Each cluster has its own api server, so each one has its own limits.
+    Return None if the scheduler limits are not configured.
+    """
+    if scheduler_limits is None:
+        return None
+    with schedulers_lock:
+        if context not in schedulers:
+            schedulers[context] = RequestScheduler(**scheduler_limits)
+        return schedulers[context]
+
+
+class ThreadLocalStdout():
+    """
+    sys.stdout replacement that sends the output of threads running
+    through run() to a buffer per thread. Other threads write to stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, 'buffer', None) or self.stream
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def run(self, func, *args):
+        """
+        Run func(*args) capturing its output
+
+        Return:
+            output, error (None if func completed successfully)
+        """
+        self._local.buffer = io.StringIO()
+        error = None
+        try:
+            func(*args)
+        except SystemExit as exc:
+            error = 'exited with code {}'.format(exc.code)
+        except Exception as exc:
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        finally:
+            output = self._local.buffer.getvalue()
+            self._local.buffer = None
+        return output, error
+
+
+def run_on_contexts(contexts, func, *, timeout=None):
+    """
+    Run func(context) concurrently for all contexts. A failure or timeout
+    on one cluster does not affect the others.
+
+    Arguments:
+        contexts (list): kubeconfig contexts names
+        func     (func): function called with the context name
+
+    Keyword arguments (opt):
+        timeout (float): max seconds to wait for the clusters
+
+    Return:
+        list of (context, output, error) in the same order as contexts
+    """
+    if not isinstance(sys.stdout, ThreadLocalStdout):
+        sys.stdout = ThreadLocalStdout(sys.stdout)
+    capture = sys.stdout
+
+    outputs = [None] * len(contexts)
+
+    def worker(pos, context):
+        outputs[pos] = capture.run(func, context)
+
+    # Daemon threads: a cluster that timed out does not keep the process
+    # running after the report
+    threads = [threading.Thread(target=worker, args=(pos, context),
+                                daemon=True)
+               for pos, context in enumerate(contexts)]
+    for thread in threads:
+        thread.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for thread in threads:
+        thread.join(None if deadline is None
+                    else max(0, deadline - time.monotonic()))
+
+    results = list()
+    for context, output in zip(contexts, outputs):
+        if output is None:
+            results.append((context, '',
+                            'timed out after {}s'.format(timeout)))
+        else:
+            results.append((context,) + output)
+    return results
+
+
+def show_contexts_report(results):
+    """
+    Show the output of each cluster tagged by context name.
+    Outputs are shown one cluster after the other, they are not merged.
+
+    Return:
+        number of clusters that failed
+    """
+    failed = [context for context, _, error in results if error]
+    for context, output, error in results:
+        msg("blue", "Cluster: {}".format(context))
+        if output:
+            print(output, end='' if output.endswith('\n') else '\n')
+        if error:
+            msg("red", "  Error: {}".format(error))
+    msg("cyan", "{}/{} clusters ok".format(len(results) - len(failed),
+                                           len(results)))
+    if failed:
+        msg("red", "Failed clusters: {}".format(', '.join(failed)))
+    return len(failed)
 
 
 def setup_logging(logfile=None, *,
@@ -113,7 +349,192 @@ def setup_logging(logfile=None, *,
     return logging.getLogger(__name__)
 
 
-def run_cmd(cmd):
+class RetryableRequest(Exception):
+    """
+    Raised by a request function to ask the scheduler to retry it
+
+    Arguments (opt):
+        retry_after (float): seconds the server asked us to wait
+        result           : value returned to the caller when retries
+                           are exhausted. If None, the exception is raised
+    """
+    def __init__(self, retry_after=None, result=None):
+        super().__init__(retry_after, result)
+        self.retry_after = retry_after
+        self.result = result
+
+
+class RequestScheduler():
+    """
+    Client side scheduler for api server requests.
+
+    Every request takes a token from a token bucket (qps/burst), waits for
+    a free in-flight slot and is served by priority (lower value first,
+    FIFO within the same priority). Requests raising RetryableRequest are
+    retried with exponential backoff and full jitter, honoring the
+    server Retry-After when informed.
+    """
+    def __init__(self, *, qps=5.0, burst=10, max_inflight=4, retries=3,
+                 backoff=0.5, max_backoff=30.0):
+        if qps <= 0 or burst < 1 or max_inflight < 1 or retries < 0:
+            raise ValueError("Invalid scheduler limits")
+        self.qps = qps
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counters = collections.Counter()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._inflight = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _count(self, name):
+        with self._cond:
+            self.counters[name] += 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last_refill) * self.qps)
+        self._last_refill = now
+
+    def _acquire(self, priority):
+        """
+        Block until the request is the highest priority one waiting,
+        there is a free in-flight slot and a token available
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            queued = throttled = False
+            while True:
+                if self._waiting[0] != ticket or \
+                   self._inflight >= self.max_inflight:
+                    queued = True
+                    self._cond.wait()
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    break
+                throttled = True
+                self._cond.wait((1 - self._tokens) / self.qps)
+            self.counters['queued'] += queued
+            self.counters['throttled'] += throttled
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._inflight += 1
+            self.counters['wait_ms'] += int((time.monotonic() - start) * 1000)
+            self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def _delay(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = min(self.max_backoff, retry_after) + delay / 2
+        return delay
+
+    def call(self, func, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Run func(*args, **kwargs) under the scheduler limits
+
+        Keyword arguments (opt):
+            priority (int): request priority class, default is
+                            PRIORITY_INTERACTIVE
+        """
+        self._count('requests')
+        attempt = 0
+        while True:
+            self._acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except RetryableRequest as exc:
+                if attempt >= self.retries:
+                    self._count('failed')
+                    if exc.result is None:
+                        raise
+                    return exc.result
+                delay = self._delay(attempt, exc.retry_after)
+                log.debug("Request throttled, retry %s/%s in %.2fs",
+                          attempt + 1, self.retries, delay)
+                self._count('retries')
+                attempt += 1
+            finally:
+                self._release()
+            time.sleep(delay)
+
+    def stats(self):
+        """
+        Return scheduler counters
+        """
+        with self._cond:
+            return dict(self.counters, inflight=self._inflight,
+                        waiting=len(self._waiting))
+
+
+def kube_bin(context=None):
+    """
+    Return the oc command line prefix for the kubeconfig context
+    (active context if None)
+    """
+    cmd = KUBE_BIN
+    if context:
+        cmd += ' --context={}'.format(shlex.quote(context))
+    if request_timeout:
+        cmd += ' --request-timeout={}s'.format(
+            int(math.ceil(request_timeout)))
+    return cmd
+
+
+def list_contexts():
+    """
+    Return all kubeconfig contexts names
+    """
+    oc_output = exec_cmd("{} config get-contexts -o name".format(KUBE_BIN))
+    if oc_output[0] > 0:
+        msg("red", oc_output[1], 1)
+    return oc_output[1].split()
+
+
+def run_cmd(cmd, *, priority=PRIORITY_INTERACTIVE, context=None):
+    """
+    Execute a command on the operating system through the request scheduler.
+    Commands failing because the api server is throttling are retried.
+
+    Arguments:
+        cmd    (str): the command to be executed
+
+    Keyword arguments (opt):
+        priority (int): request priority class, default is
+                        PRIORITY_INTERACTIVE
+        context  (str): kubeconfig context the command talks to. It selects
+                        the scheduler, it does not change the command
+
+    Return:
+        same as exec_cmd
+    """
+    def _run():
+        returncode, output = exec_cmd(cmd)
+        if returncode and THROTTLED_RE.search(output):
+            raise RetryableRequest(result=(returncode, output))
+        return returncode, output
+
+    scheduler = get_scheduler(context)
+    if scheduler is None:
+        return exec_cmd(cmd)
+    return scheduler.call(_run, priority=priority)
+
+
+def exec_cmd(cmd):
     """
     Execute a command on the operating system
 
@@ -252,12 +673,17 @@ def return_dict_value(dictionary, keys):
         dictionary  (dict):  dictionary
         key         (list):  A list with keys
     """
-    log.debug("-------------------------------------------")
-    log.debug("Dictionary: %s", pprint.pformat(dictionary))
-    log.debug("Keys: %s", keys)
+    # pformat the whole pod json only when debug messages are shown
+    debug = logging.root.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug("-------------------------------------------")
+        log.debug("Dictionary: %s", pprint.pformat(dictionary))
+        log.debug("Keys: %s", keys)
     if len(keys) > 1:
-        log.debug("There are more keys: %s", keys[1:])
-        log.debug("Call recursive with dictionary: %s", pprint.pformat(dictionary[keys[0]]))
+        if debug:
+            log.debug("There are more keys: %s", keys[1:])
+            log.debug("Call recursive with dictionary: %s",
+                      pprint.pformat(dictionary[keys[0]]))
         if isinstance(dictionary, dict):
             try:
                 return return_dict_value(dictionary[keys[0]], keys[1:])
@@ -322,8 +748,9 @@ class Container():
 
 
 class Pod():
-    def __init__(self, podname, podjson):
+    def __init__(self, podname, podjson, context=None):
         self.podname = podname
+        self.context = context
         self.qosclass = podjson['status']['qosClass']
         self.status = podjson['status']['phase']
         self.conditions = podjson['status']['conditions']
@@ -333,6 +760,8 @@ class Pod():
         self.affinity = return_dict_value(podjson, ['spec', 'affinity'])
         self.nodeselector = return_dict_value(podjson, ['spec', 'nodeSelector'])
         self.starttime = return_dict_value(podjson, ['status', 'startTime'])
+        self.creationtime = return_dict_value(podjson,
+                                              ['metadata', 'creationTimestamp'])
         self.containers = list()
         self.containers = [Container(i['name'])
                            for i in podjson['spec']['containers']]
@@ -373,13 +802,43 @@ class Pod():
         """
         return self.num_containers() == self.num_containers_ready(True)
 
+    def num_restarts(self):
+        """
+        Return the sum of containers restart count
+        """
+        return sum(container.restart or 0 for container in self.containers)
+
+    def start_timestamp(self):
+        """
+        Return pod start time (creation time if not started) in seconds
+        since epoch, or None if unknown
+        """
+        starttime = self.starttime or self.creationtime
+        if not starttime:
+            return None
+        try:
+            return calendar.timegm(time.strptime(starttime,
+                                                 '%Y-%m-%dT%H:%M:%SZ'))
+        except ValueError:
+            return None
+
 
 ##############################################################################
 # Instantiate all Pods
 # Return a list with all Pod objects
 ##############################################################################
-def create_pods_inst(*, podsjson):
-    return [Pod(i['metadata']['name'], i) for i in podsjson['items']]
+def create_pods_inst(*, podsjson, context=None):
+    return [Pod(i['metadata']['name'], i, context) for i in podsjson['items']]
+
+
+##############################################################################
+# Instantiate Pods one at a time
+# Return a generator of Pod objects. podsjson is already loaded whole, only
+# Pod objects are not kept in memory
+##############################################################################
+def iter_pods_inst(*, podsjson, context=None):
+    for i in podsjson['items']:
+        yield Pod(i['metadata']['name'], i, context)
 
 
 ##############################################################################
@@ -459,6 +918,140 @@ def cmd_limits(pods):
                 format(container.limit_cpu, container.limit_mem))
 
 
+##############################################################################
+# Show the top pods by metric
+##############################################################################
+class TopN():
+    """
+    Keep the size entries with the highest score using a bounded min-heap.
+    Adding an entry is O(log size). On equal score the first one added wins.
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Invalid size")
+        self.size = size
+        self._heap = list()
+        self._seq = itertools.count()
+
+    def push(self, score, item):
+        entry = (score, -next(self._seq), item)
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """
+        Return the items, highest score first
+        """
+        return [item for _, _, item in
+                sorted(self._heap, key=lambda i: i[:2], reverse=True)]
+
+
+def format_age(seconds):
+    """
+    Return age in seconds in kubectl format (e.g. 3d4h, 5h10m, 42s)
+    """
+    if seconds is None:
+        return ''
+    seconds = max(0, int(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return '{}d{}h'.format(days, hours)
+    if hours:
+        return '{}h{}m'.format(hours, minutes)
+    if minutes:
+        return '{}m{}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+def pod_row(pod, now):
+    start = pod.start_timestamp()
+    return [pod.podname,
+            pod.num_restarts(),
+            format_age(now - start if start is not None else None),
+            '{}/{}'.format(pod.num_containers_ready(True), pod.num_containers()),
+            pod.status,
+            pod.nodename]
+
+
+def nolimits_row(item, now):
+    pod, container = item
+    return [pod.podname,
+            container.name,
+            container.limit_cpu,
+            container.limit_mem,
+            container.restart]
+
+
+def top_restarts(pod, now):
+    restarts = pod.num_restarts()
+    if restarts:
+        yield restarts, pod
+
+
+def top_age(pod, now):
+    start = pod.start_timestamp()
+    if start is not None:
+        yield now - start, pod
+
+
+def top_notready(pod, now):
+    # Completed pods have no ready container, they are not relevant
+    if pod.status != 'Succeeded' and not pod.is_all_containers_ready():
+        start = pod.start_timestamp()
+        yield (now - start if start is not None else 0), pod
+
+
+def top_nolimits(pod, now):
+    for container in pod.containers:
+        if not container.limit_cpu or not container.limit_mem:
+            yield container.restart or 0, (pod, container)
+
+
+POD_HEADER = ['Pod', 'Restarts', 'Age', 'Ready', 'Status', 'Node']
+
+# metric name: (title, table header,
+#               function yielding (score, item), function returning item row)
+TOP_METRICS = {
+    'restarts': ('Pods with most restarts', POD_HEADER, top_restarts,
+                 pod_row),
+    'age': ('Oldest pods', POD_HEADER, top_age, pod_row),
+    'notready': ('Oldest not ready pods', POD_HEADER, top_notready, pod_row),
+    'nolimits': ('Containers without cpu or memory limit',
+                 ['Pod', 'Container', 'Limit cpu', 'Limit mem', 'Restarts'],
+                 top_nolimits, nolimits_row),
+}
+
+
+def cmd_top(pods, *, metrics, size=20):
+    """
+    Go through the pods once keeping a bounded heap per metric, so ranking
+    N pods takes O(N log size) time and each heap keeps at most size
+    entries. Table rows are built only for the entries kept. Note the pods
+    json returned by oc is still loaded whole, only the Pod objects are
+    created one at a time.
+    """
+    now = time.time()
+    metrics = list(dict.fromkeys(metrics))
+    heaps = {metric: TopN(size) for metric in metrics}
+    num_pods = 0
+    for pod in pods:
+        num_pods += 1
+        for metric, heap in heaps.items():
+            for score, item in TOP_METRICS[metric][2](pod, now):
+                heap.push(score, item)
+
+    for metric in metrics:
+        title, header, _, row_func = TOP_METRICS[metric]
+        rows = [row_func(item, now) for item in heaps[metric].items()]
+        msg("cyan", "{} ({} of {} pods)".format(title, len(rows), num_pods))
+        if rows:
+            print_table(header, rows, alignl=header[:2])
+
+
 ##############################################################################
 # Show diag information
 ##############################################################################
@@ -494,19 +1087,49 @@ def cmd_diag(pods):
                 msg("yellow", "  * Container events:")
                 oc_output = run_cmd(
                     "{} get events --field-selector='involvedObject.name={}'".
-                    format(KUBE_BIN, pod.podname))
+                    format(kube_bin(pod.context), pod.podname),
+                    priority=PRIORITY_BULK, context=pod.context)
                 print(oc_output[1])
                 msg("yellow", "  * Container logs:")
-                oc_output = run_cmd("{} logs {} -c {} | head -10".format(
-                    KUBE_BIN, pod.podname, container.name))
-                print(oc_output[1])
+                # No "| head" here: the pipeline exit code would hide
+                # oc errors from run_cmd throttling detection
+                oc_output = run_cmd(
+                    "{} logs {} -c {} --limit-bytes={}".format(
+                        kube_bin(pod.context), pod.podname, container.name,
+                        LOGS_LIMIT_BYTES),
+                    priority=PRIORITY_BULK, context=pod.context)
+                if oc_output[0] > 0:
+                    print(oc_output[1])
+                else:
+                    print(''.join(oc_output[1].splitlines(True)[:10]))
+
+
+##############################################################################
+# Load pods and run the command for a kubeconfig context
+##############################################################################
+def run_podinfo(args, context=None):
+    oc_output = run_cmd("{} get pod -o json".format(kube_bin(context)),
+                        context=context)
+    if oc_output[0] > 0:
+        msg("red", oc_output[1], 1)
+
+    # Create a list with all pods instances. Commands that go through the
+    # pods only once get them one at a time
+    if getattr(args, 'stream_pods', False):
+        pods = iter_pods_inst(podsjson=json.loads(oc_output[1]),
+                              context=context)
+    else:
+        pods = create_pods_inst(podsjson=json.loads(oc_output[1]),
+                                context=context)
+
+    args.func(pods)
 
 
 ##############################################################################
 # Main function
 ##############################################################################
 def main():
-    global log
+    global log, scheduler_limits, request_timeout
     # Parser the command line
     args = parse_parameters()
 
@@ -514,14 +1137,31 @@ def main():
     log = setup_logging() if args.debug else logging
     log.debug('CMD line args: %s', vars(args))
 
-    oc_output = run_cmd("{} get pod -o json".format(KUBE_BIN))
-    if oc_output[0] > 0:
-        msg("red", oc_output[1], 1)
-
-    # Create a list with all pods instances
-    pods = create_pods_inst(podsjson=json.loads(oc_output[1]))
-
-    args.func(pods)
+    scheduler_limits = dict(qps=args.qps, burst=args.burst,
+                            max_inflight=args.max_inflight,
+                            retries=args.retries)
+    try:
+        get_scheduler()
+    except ValueError as exc:
+        msg("red", "Error: {}".format(exc), 1)
+
+    contexts = list_contexts() if args.all_contexts else args.contexts
+    failed = 0
+    if not contexts:
+        run_podinfo(args)
+    else:
+        request_timeout = args.timeout
+        results = run_on_contexts(contexts,
+                                  lambda context: run_podinfo(args, context),
+                                  timeout=args.timeout)
+        failed = show_contexts_report(results)
+
+    for context, sched in list(schedulers.items()):
+        log.debug('Scheduler counters (%s): %s',
+                  context or 'active context', sched.stats())
+
+    if failed:
+        sys.exit(1)
 
 
 ##############################################################################
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Plugins are standalone scripts, one per directory
+for plugin in ('netpol', 'podinfo'):
+    sys.path.insert(0, os.path.join(ROOT, plugin))
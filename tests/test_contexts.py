@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+import podinfo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('plugin', ['netpol', 'podinfo'])
+def test_run_on_contexts_exits_after_timeout(plugin):
+    script = textwrap.dedent('''
+        import sys, time
+        sys.path.insert(0, {path!r})
+        import {plugin} as plugin
+
+        def run(context):
+            plugin.msg("nocolor", "hello from " + context)
+            if context == "slow":
+                time.sleep(6)
+
+        results = plugin.run_on_contexts(["fast", "slow"], run, timeout=1)
+        plugin.show_contexts_report(results)
+    ''').format(path=os.path.join(ROOT, plugin), plugin=plugin)
+
+    start = time.monotonic()
+    proc = subprocess.run([sys.executable, '-c', script],
+                          stdout=subprocess.PIPE, universal_newlines=True,
+                          timeout=30)
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 4
+    assert 'hello from fast' in proc.stdout
+    assert 'hello from slow' not in proc.stdout
+    assert 'timed out after 1s' in proc.stdout
+    assert '1/2 clusters ok' in proc.stdout
+
+
+def test_run_on_contexts_isolates_errors(monkeypatch):
+    # run_on_contexts replaces sys.stdout, restore it after the test
+    monkeypatch.setattr(sys, 'stdout', sys.stdout)
+
+    def run(context):
+        if context == 'bad':
+            raise RuntimeError('boom')
+        podinfo.msg("nocolor", "ok " + context)
+
+    results = podinfo.run_on_contexts(['c1', 'bad', 'c2'], run, timeout=10)
+
+    assert [i[0] for i in results] == ['c1', 'bad', 'c2']
+    assert results[0][1:] == ('ok c1\n', None)
+    assert results[1][2] == 'RuntimeError: boom'
+    assert results[2][1:] == ('ok c2\n', None)
+
+
+def test_kube_bin_request_timeout_rounds_up(monkeypatch):
+    monkeypatch.setattr(podinfo, 'request_timeout', 0.5)
+    assert podinfo.kube_bin('ctx') == \
+        'oc --context=ctx --request-timeout=1s'
+    monkeypatch.setattr(podinfo, 'request_timeout', None)
+    assert podinfo.kube_bin() == 'oc'
@@ -0,0 +1,381 @@
+import logging
+import random
+import time
+import types
+
+import kubernetes.client as k8s
+import pytest
+
+import netpol
+
+
+def selector(labels=None):
+    return k8s.V1LabelSelector(match_labels=labels)
+
+
+def ip_block_peer(cidr, excepts=None):
+    return k8s.V1NetworkPolicyPeer(
+        ip_block=k8s.V1IPBlock(cidr=cidr, _except=excepts))
+
+
+def networkpolicy(name, ingress=None, *, namespace='ns1', target=None,
+                  egress=None, types=None):
+    return k8s.V1NetworkPolicy(
+        metadata=k8s.V1ObjectMeta(name=name, namespace=namespace),
+        spec=k8s.V1NetworkPolicySpec(
+            pod_selector=target or selector({'app': 'web'}),
+            ingress=ingress, egress=egress, policy_types=types))
+
+
+def ingress_rule(peers=None, ports=None):
+    return k8s.V1NetworkPolicyIngressRule(
+        _from=peers,
+        ports=[k8s.V1NetworkPolicyPort(port=i, protocol='TCP')
+               for i in ports] if ports else None)
+
+
+def analyze(*netpols):
+    rules = netpol.create_ingress_rules(netpols)
+    report = netpol.analyze_ingress_rules(rules)
+    return {'duplicate': [[str(i) for i in same]
+                          for same in report['duplicate']],
+            'shadowed': {str(rule): sorted(str(i) for i in shadowing)
+                         for shadowed, shadowing in report['shadowed']
+                         for rule in shadowed},
+            'allow_all': [str(i) for i in report['allow_all']]}
+
+
+def test_all_pods_peer_is_not_any_source():
+    all_pods = k8s.V1NetworkPolicyPeer(namespace_selector=selector(),
+                                       pod_selector=selector())
+    report = analyze(
+        networkpolicy('pods', [ingress_rule([all_pods])]),
+        networkpolicy('external', [ingress_rule(
+            [ip_block_peer('203.0.113.0/24')])]))
+    assert report['allow_all'] == []
+    assert report['shadowed'] == {}
+
+
+def test_all_pods_peer_shadows_pod_peers():
+    all_pods = k8s.V1NetworkPolicyPeer(namespace_selector=selector())
+    frontend = k8s.V1NetworkPolicyPeer(
+        namespace_selector=selector({'env': 'prod'}),
+        pod_selector=selector({'app': 'fe'}))
+    report = analyze(networkpolicy('all', [ingress_rule([all_pods])]),
+                     networkpolicy('fe', [ingress_rule([frontend])]))
+    assert report['shadowed'] == {'ns1/fe ingress[0]': ['ns1/all ingress[0]']}
+
+
+def test_ipv4_any_does_not_shadow_ipv6():
+    report = analyze(
+        networkpolicy('v4', [ingress_rule([ip_block_peer('0.0.0.0/0')])]),
+        networkpolicy('v6', [ingress_rule([ip_block_peer('2001:db8::/32')])]),
+        networkpolicy('net', [ingress_rule([ip_block_peer('10.0.0.0/8')])]))
+    assert report['allow_all'] == []
+    assert report['shadowed'] == {'ns1/net ingress[0]': ['ns1/v4 ingress[0]']}
+
+
+def test_allow_all_rules():
+    report = analyze(
+        networkpolicy('nofrom', [ingress_rule(ports=[80])]),
+        networkpolicy('both', [ingress_rule([ip_block_peer('0.0.0.0/0'),
+                                             ip_block_peer('::/0')])]),
+        networkpolicy('except', [ingress_rule([
+            ip_block_peer('0.0.0.0/0', ['10.0.0.0/8']),
+            ip_block_peer('::/0')])]))
+    assert report['allow_all'] == ['ns1/nofrom ingress[0]',
+                                   'ns1/both ingress[0]']
+
+
+def test_duplicate_and_shadowed_ip_blocks():
+    report = analyze(
+        networkpolicy('a', [ingress_rule([ip_block_peer('10.1.0.0/16')],
+                                         [80])]),
+        networkpolicy('b', [ingress_rule([ip_block_peer('10.1.0.0/16')],
+                                         [80])]),
+        networkpolicy('wide', [ingress_rule(
+            [ip_block_peer('10.0.0.0/8', ['10.2.0.0/16'])], [80, 443])]),
+        networkpolicy('excluded', [ingress_rule(
+            [ip_block_peer('10.2.3.0/24')], [80])]),
+        networkpolicy('other', [ingress_rule(
+            [ip_block_peer('10.1.0.0/16')], [80])], namespace='ns2'))
+    assert report['duplicate'] == [['ns1/a ingress[0]', 'ns1/b ingress[0]']]
+    assert report['shadowed'] == {'ns1/a ingress[0]': ['ns1/wide ingress[0]'],
+                                  'ns1/b ingress[0]': ['ns1/wide ingress[0]']}
+
+
+def test_rules_covering_each_other_are_duplicate():
+    report = analyze(
+        networkpolicy('x', [ingress_rule([ip_block_peer('10.0.0.0/8')])]),
+        networkpolicy('y', [ingress_rule([ip_block_peer('10.0.0.0/8'),
+                                          ip_block_peer('10.1.0.0/16')])]))
+    assert report['duplicate'] == [['ns1/x ingress[0]', 'ns1/y ingress[0]']]
+    assert report['shadowed'] == {}
+
+
+def test_equivalent_rules_shadowed_by_wider_rule():
+    report = analyze(
+        networkpolicy('x', [ingress_rule([ip_block_peer('10.0.0.0/8')])]),
+        networkpolicy('y', [ingress_rule([ip_block_peer('10.0.0.0/8'),
+                                          ip_block_peer('10.1.0.0/16')])]),
+        networkpolicy('wide', [ingress_rule([ip_block_peer('10.0.0.0/7')])]))
+    assert report['duplicate'] == [['ns1/x ingress[0]', 'ns1/y ingress[0]']]
+    assert report['shadowed'] == {
+        'ns1/x ingress[0]': ['ns1/wide ingress[0]'],
+        'ns1/y ingress[0]': ['ns1/wide ingress[0]']}
+
+
+def test_cidr_index_covering():
+    entries = [(netpol.normalize_ip_block(k8s.V1IPBlock(cidr=cidr,
+                                                        _except=excepts)),
+                cidr)
+               for cidr, excepts in (('0.0.0.0/0', ['10.0.0.0/8']),
+                                     ('10.0.0.0/8', None),
+                                     ('10.1.0.0/16', ['10.1.1.0/24']),
+                                     ('192.168.0.0/16', None),
+                                     ('::/0', None))]
+    index = netpol.CidrIndex(entries)
+
+    def covering(cidr):
+        peer = netpol.normalize_ip_block(k8s.V1IPBlock(cidr=cidr))
+        return sorted(value for _, value in index.covering(peer))
+
+    assert covering('10.1.2.0/24') == ['10.0.0.0/8', '10.1.0.0/16']
+    assert covering('10.1.1.5/32') == ['10.0.0.0/8']
+    assert covering('172.16.0.0/12') == ['0.0.0.0/0']
+    assert covering('2001:db8::/32') == ['::/0']
+
+
+##############################################################################
+# PolicyMatcher
+##############################################################################
+def random_selector(rand):
+    choice = rand.random()
+    if choice < 0.2:
+        return selector()
+    if choice < 0.4:
+        return k8s.V1LabelSelector(match_expressions=[
+            k8s.V1LabelSelectorRequirement(
+                key='tier',
+                operator=rand.choice(['In', 'NotIn', 'Exists',
+                                      'DoesNotExist']),
+                values=['x'])])
+    return selector({'app': rand.choice('abc')})
+
+
+def random_peer(rand):
+    if rand.random() < 0.2:
+        return ip_block_peer('10.0.0.0/%d' % rand.choice([8, 24]),
+                             rand.choice([None, ['10.0.0.0/30']]))
+    namespace_selector = rand.choice(
+        [None, selector({'env': rand.choice('pq')}), selector()])
+    return k8s.V1NetworkPolicyPeer(namespace_selector=namespace_selector,
+                                   pod_selector=random_selector(rand))
+
+
+def random_networkpolicy(rand, namespace, name):
+    ingress = [ingress_rule(rand.choice([None, [random_peer(rand)
+                                                for _ in range(2)]]),
+                            rand.choice([None, [80]]))
+               for _ in range(rand.randint(0, 2))]
+    egress = [k8s.V1NetworkPolicyEgressRule(to=[random_peer(rand)])
+              for _ in range(rand.randint(0, 2))]
+    return networkpolicy(name, ingress, namespace=namespace,
+                         target=random_selector(rand), egress=egress,
+                         types=rand.choice([None, ['Ingress'], ['Egress'],
+                                            ['Ingress', 'Egress']]))
+
+
+def namespace_obj(name, labels):
+    return k8s.V1Namespace(metadata=k8s.V1ObjectMeta(name=name,
+                                                     labels=labels))
+
+
+def pod_obj(namespace, name, labels, pod_ip=None):
+    return k8s.V1Pod(metadata=k8s.V1ObjectMeta(namespace=namespace,
+                                               name=name, labels=labels),
+                     status=k8s.V1PodStatus(pod_ip=pod_ip))
+
+
+def assert_same_evaluation(matcher, expected):
+    assert matcher.targets == expected.targets
+    assert matcher.peer_pods == expected.peer_pods
+    for pod in matcher.pods:
+        for direction in ('Ingress', 'Egress'):
+            allowed = matcher.allowed_peers(pod, direction)
+            for peer in matcher.pods:
+                assert matcher.allowed(pod, peer, direction, port=80) == \
+                    expected.allowed(pod, peer, direction, port=80)
+                assert matcher.allowed(pod, peer, direction) == \
+                    (allowed is None or peer in allowed)
+
+
+def test_policy_matcher_incremental_matches_full_rebuild():
+    rand = random.Random(1)
+    names = ['n1', 'n2', 'n3']
+    state = {'Namespace': {name: namespace_obj(name, {'env': 'p'})
+                           for name in names},
+             'Pod': {}, 'NetworkPolicy': {}}
+    matcher = netpol.PolicyMatcher()
+    matcher.apply_snapshot(list(state['Namespace'].values()), [], [])
+
+    for step in range(400):
+        choice = rand.random()
+        event_type = 'MODIFIED'
+        if choice < 0.35:
+            kind = 'Pod'
+            obj = pod_obj(rand.choice(names), 'p%d' % rand.randrange(12),
+                          {'app': rand.choice('abc'),
+                           'tier': rand.choice('xy')},
+                          rand.choice([None, '10.0.0.1', '10.0.0.9',
+                                       '10.1.0.1', 'fd00::1']))
+        elif choice < 0.7:
+            kind = 'NetworkPolicy'
+            obj = random_networkpolicy(rand, rand.choice(names),
+                                       'np%d' % rand.randrange(6))
+        else:
+            kind = 'Namespace'
+            obj = namespace_obj(rand.choice(names),
+                                {'env': rand.choice('pq')})
+        key = (obj.metadata.namespace, obj.metadata.name) \
+            if kind != 'Namespace' else obj.metadata.name
+        if kind != 'Namespace' and key in state[kind] and \
+           rand.random() < 0.3:
+            event_type = 'DELETED'
+            obj = state[kind].pop(key)
+        else:
+            state[kind][key] = obj
+
+        if step % 50 == 49:
+            matcher.apply_snapshot(list(state['Namespace'].values()),
+                                   list(state['Pod'].values()),
+                                   list(state['NetworkPolicy'].values()))
+        else:
+            matcher.apply_event(kind, {'type': event_type, 'object': obj})
+
+        expected = netpol.PolicyMatcher()
+        expected.apply_snapshot(list(state['Namespace'].values()),
+                                list(state['Pod'].values()),
+                                list(state['NetworkPolicy'].values()))
+        assert_same_evaluation(matcher, expected)
+
+
+def test_policy_matcher_changed_pods():
+    matcher = netpol.PolicyMatcher()
+    frontend = k8s.V1NetworkPolicyPeer(pod_selector=selector({'app': 'fe'}))
+    matcher.apply_snapshot(
+        [namespace_obj('ns1', {})],
+        [pod_obj('ns1', 'web', {'app': 'web'}),
+         pod_obj('ns1', 'fe', {'app': 'fe'}),
+         pod_obj('ns1', 'db', {'app': 'db'})],
+        [networkpolicy('web', [ingress_rule([frontend])])])
+
+    assert matcher.isolating_policies(('ns1', 'web'), 'Ingress') == \
+        [('ns1', 'web')]
+    assert matcher.allowed_peers(('ns1', 'web'), 'Ingress') == \
+        {('ns1', 'fe')}
+    assert matcher.allowed_peers(('ns1', 'web'), 'Egress') is None
+    assert matcher.connection_allowed(('ns1', 'fe'), ('ns1', 'web'))
+    assert not matcher.connection_allowed(('ns1', 'db'), ('ns1', 'web'))
+
+    # db becomes a frontend: the web pod evaluation changes
+    changed = matcher.set_pod('ns1', 'db', {'app': 'fe'})
+    assert changed == {('ns1', 'db'), ('ns1', 'web')}
+    assert matcher.connection_allowed(('ns1', 'db'), ('ns1', 'web'))
+    assert matcher.set_pod('ns1', 'db', {'app': 'fe'}) == set()
+
+
+def test_policy_matcher_ip_block_peers(capsys):
+    matcher = netpol.PolicyMatcher()
+    egress = k8s.V1NetworkPolicyEgressRule(
+        to=[ip_block_peer('0.0.0.0/0', ['169.254.169.254/32'])])
+    matcher.apply_snapshot(
+        [namespace_obj('ns1', {})],
+        [pod_obj('ns1', 'web', {'app': 'web'}, '10.0.0.1'),
+         pod_obj('ns1', 'db', {'app': 'db'}, '10.0.0.2')],
+        [networkpolicy('web', egress=[egress], types=['Egress'])])
+
+    assert matcher.allowed_peers(('ns1', 'web'), 'Egress') == \
+        {('ns1', 'web'), ('ns1', 'db')}
+    assert matcher.connection_allowed(('ns1', 'web'), ('ns1', 'db'))
+
+    netpol.show_pod_evaluation(matcher, ('ns1', 'web'))
+    out = capsys.readouterr().out
+    assert 'allowed to pods: 1/1' in out
+    assert 'allowed to cidr 0.0.0.0/0 except 169.254.169.254/32' in out
+
+    # db gets an excluded IP: the web pod evaluation changes
+    changed = matcher.set_pod('ns1', 'db', {'app': 'db'}, '169.254.169.254')
+    assert changed == {('ns1', 'db'), ('ns1', 'web')}
+    assert not matcher.connection_allowed(('ns1', 'web'), ('ns1', 'db'))
+
+
+class FakeWatchK8s():
+    """
+    K8s replacement: list calls return objects with an increasing resource
+    version and watch calls are recorded
+    """
+    def __init__(self):
+        self.version = 0
+        self.watches = list()
+
+    def _list(self, items=()):
+        self.version += 1
+        return types.SimpleNamespace(
+            items=list(items),
+            metadata=types.SimpleNamespace(resource_version=str(self.version)))
+
+    def list_namespaces(self):
+        return self._list([namespace_obj('ns1', {})])
+
+    def list_all_pods(self):
+        return self._list([pod_obj('ns1', 'web', {'app': 'web'})])
+
+    def list_all_networkpolicy(self):
+        return self._list()
+
+    def watch(self, kind, events, resource_version, stop):
+        self.watches.append((kind, resource_version))
+        if kind != 'Pod':
+            return
+        if sum(1 for i in self.watches if i[0] == 'Pod') == 1:
+            # First watches: ask for a resync
+            events.put((stop, 'RESYNC', None))
+        else:
+            # Unknown kind ends watch_policy_changes
+            events.put((stop, 'Unknown', {'type': 'ADDED', 'object': None}))
+
+
+def test_watch_starts_from_snapshot_versions(monkeypatch):
+    monkeypatch.setattr(netpol, 'log', logging)
+    fake = FakeWatchK8s()
+    matcher = netpol.PolicyMatcher()
+    _, versions = netpol.load_policy_snapshot(fake, matcher)
+    assert versions == {'Namespace': '1', 'Pod': '2', 'NetworkPolicy': '3'}
+
+    with pytest.raises(ValueError):
+        netpol.watch_policy_changes(fake, matcher, 'ns1', versions)
+
+    # Watch threads of the first snapshot may still be starting
+    deadline = time.monotonic() + 5
+    while len(fake.watches) < 6 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(fake.watches) == [
+        ('Namespace', '1'), ('Namespace', '4'),
+        ('NetworkPolicy', '3'), ('NetworkPolicy', '6'),
+        ('Pod', '2'), ('Pod', '5')]
+
+
+def test_show_ip_block_peer_as_defined(capsys):
+    netpol.show_networkpolicy_peer(
+        ip_block_peer('10.1.2.3/16', ['10.1.1.0/24', '10.1.1.0/24']), False)
+    out = capsys.readouterr().out
+    assert "cidr: '10.1.2.3/16'" in out
+    assert 'cidr (normalized): 10.1.0.0/16' in out
+    assert "except: ['10.1.1.0/24', '10.1.1.0/24']" in out
+    assert 'except (normalized): 10.1.1.0/24\n' in out
+
+    netpol.show_networkpolicy_peer(ip_block_peer('10.0.0.0/8'), False)
+    out = capsys.readouterr().out
+    assert "cidr: '10.0.0.0/8'" in out
+    assert 'normalized' not in out
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import podinfo
+
+
+def pod_json(name, *, phase='Running', ready=True, restarts=0,
+             start='2026-10-01T00:00:00Z', limits=None):
+    return {'metadata': {'name': name,
+                         'creationTimestamp': start},
+            'spec': {'containers': [{'name': 'c',
+                                     'image': 'image',
+                                     'imagePullPolicy': 'Always',
+                                     'resources': {'limits': limits or {}}}]},
+            'status': {'qosClass': 'BestEffort',
+                       'phase': phase,
+                       'conditions': [],
+                       'startTime': start,
+                       'containerStatuses': [{'name': 'c',
+                                              'ready': ready,
+                                              'restartCount': restarts,
+                                              'state': {'running': {}},
+                                              'imageID': 'id'}]}}
+
+
+def pods(*items):
+    return list(podinfo.iter_pods_inst(podsjson={'items': list(items)}))
+
+
+def test_topn_keeps_highest_scores():
+    rand = random.Random(0)
+    scores = [rand.randrange(100) for _ in range(1000)]
+    top = podinfo.TopN(10)
+    for pos, score in enumerate(scores):
+        top.push(score, pos)
+    expected = sorted(range(len(scores)),
+                      key=lambda pos: (-scores[pos], pos))[:10]
+    assert top.items() == expected
+
+
+def test_topn_invalid_size():
+    with pytest.raises(ValueError):
+        podinfo.TopN(0)
+
+
+def test_top_notready_skips_completed_pods():
+    now = podinfo.calendar.timegm((2026, 10, 19, 0, 0, 0))
+    completed = pods(pod_json('job', phase='Succeeded', ready=False,
+                              start='2026-01-01T00:00:00Z'))[0]
+    crashing = pods(pod_json('web', ready=False,
+                             start='2026-10-18T00:00:00Z'))[0]
+    assert list(podinfo.top_notready(completed, now)) == []
+    assert list(podinfo.top_notready(crashing, now)) == [(86400, crashing)]
+
+
+def test_cmd_top_builds_rows_for_kept_entries_only(monkeypatch, capsys):
+    built = list()
+
+    def row(pod, now):
+        built.append(pod.podname)
+        return podinfo.pod_row(pod, now)
+
+    title, header, func, _ = podinfo.TOP_METRICS['restarts']
+    monkeypatch.setitem(podinfo.TOP_METRICS, 'restarts',
+                        (title, header, func, row))
+    monkeypatch.setattr(podinfo, 'print_table',
+                        lambda header, rows, **kwargs: print(rows))
+
+    podinfo.cmd_top(iter(pods(*[pod_json('p{}'.format(i), restarts=i)
+                                for i in range(100)])),
+                    metrics=['restarts'], size=3)
+
+    assert built == ['p99', 'p98', 'p97']
+    assert 'Pods with most restarts (3 of 100 pods)' in capsys.readouterr().out
@@ -0,0 +1,237 @@
+import email.utils
+import threading
+import time
+
+import kubernetes
+import pytest
+
+import netpol
+import podinfo
+
+
+@pytest.fixture(params=[netpol, podinfo], ids=['netpol', 'podinfo'])
+def plugin(request):
+    return request.param
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not reached'
+        time.sleep(0.005)
+
+
+def test_invalid_limits(plugin):
+    for limits in ({'qps': 0}, {'burst': 0}, {'max_inflight': 0},
+                   {'retries': -1}):
+        with pytest.raises(ValueError):
+            plugin.RequestScheduler(**limits)
+
+
+def test_token_bucket_limits_rate(plugin):
+    scheduler = plugin.RequestScheduler(qps=20, burst=2, max_inflight=10)
+    start = time.monotonic()
+    for _ in range(6):
+        scheduler.call(lambda: None)
+    elapsed = time.monotonic() - start
+
+    # burst requests go at once, the other 4 wait 1/qps each
+    assert elapsed >= 0.18
+    stats = scheduler.stats()
+    assert stats['requests'] == 6
+    assert stats['throttled'] == 4
+
+
+def test_token_bucket_refills(plugin):
+    scheduler = plugin.RequestScheduler(qps=50, burst=2)
+    scheduler.call(lambda: None)
+    scheduler.call(lambda: None)
+    time.sleep(0.1)
+    scheduler.call(lambda: None)
+    scheduler.call(lambda: None)
+    assert scheduler.stats()['throttled'] == 0
+
+
+def test_max_inflight(plugin):
+    scheduler = plugin.RequestScheduler(qps=1000, burst=100, max_inflight=2)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def request():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    threads = [threading.Thread(target=scheduler.call, args=(request,))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_running[0] == 2
+    assert scheduler.stats()['queued'] > 0
+    assert scheduler.stats()['inflight'] == 0
+
+
+def test_priority_order(plugin):
+    scheduler = plugin.RequestScheduler(qps=1000, burst=100, max_inflight=1)
+    release = threading.Event()
+    order = list()
+
+    def submit(name, priority):
+        thread = threading.Thread(
+            target=scheduler.call, args=(order.append, name),
+            kwargs={'priority': priority})
+        thread.start()
+        return thread
+
+    blocker = threading.Thread(target=scheduler.call, args=(release.wait,))
+    blocker.start()
+    wait_for(lambda: scheduler.stats()['inflight'] == 1)
+
+    threads = list()
+    for pos, (name, priority) in enumerate(
+            [('bulk1', plugin.PRIORITY_BULK),
+             ('interactive', plugin.PRIORITY_INTERACTIVE),
+             ('bulk2', plugin.PRIORITY_BULK)]):
+        threads.append(submit(name, priority))
+        wait_for(lambda: scheduler.stats()['waiting'] == pos + 1)
+
+    release.set()
+    for thread in [blocker] + threads:
+        thread.join()
+
+    assert order == ['interactive', 'bulk1', 'bulk2']
+
+
+def test_retry_then_success(plugin):
+    scheduler = plugin.RequestScheduler(retries=3, backoff=0.001)
+    attempts = [0]
+
+    def request():
+        attempts[0] += 1
+        if attempts[0] < 3:
+            raise plugin.RetryableRequest(retry_after=0)
+        return 'ok'
+
+    assert scheduler.call(request) == 'ok'
+    assert attempts[0] == 3
+    assert scheduler.stats()['retries'] == 2
+    assert 'failed' not in scheduler.stats()
+
+
+def test_retries_exhausted_returns_result(plugin):
+    scheduler = plugin.RequestScheduler(retries=2, backoff=0.001)
+
+    def request():
+        raise plugin.RetryableRequest(result='last result')
+
+    assert scheduler.call(request) == 'last result'
+    stats = scheduler.stats()
+    assert stats['retries'] == 2
+    assert stats['failed'] == 1
+
+
+def test_retries_exhausted_raises(plugin):
+    scheduler = plugin.RequestScheduler(retries=1, backoff=0.001)
+
+    def request():
+        raise plugin.RetryableRequest()
+
+    with pytest.raises(plugin.RetryableRequest):
+        scheduler.call(request)
+
+
+def test_retry_after_is_honored(plugin):
+    scheduler = plugin.RequestScheduler(retries=1, backoff=0.001)
+    attempts = list()
+
+    def request():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise plugin.RetryableRequest(retry_after=0.2)
+
+    scheduler.call(request)
+    assert attempts[1] - attempts[0] >= 0.2
+
+
+def test_podinfo_run_cmd_retries_throttled_command(monkeypatch):
+    monkeypatch.setattr(podinfo, 'scheduler_limits',
+                        {'retries': 2, 'backoff': 0.001})
+    monkeypatch.setattr(podinfo, 'schedulers', dict())
+    outputs = iter([(1, 'Error from server (TooManyRequests): slow down'),
+                    (0, 'pods')])
+    monkeypatch.setattr(podinfo, 'exec_cmd', lambda cmd: next(outputs))
+
+    assert podinfo.run_cmd('oc get pod') == (0, 'pods')
+    assert podinfo.get_scheduler().stats()['retries'] == 1
+
+
+def k8s_with_scheduler(**limits):
+    k8s = netpol.K8s.__new__(netpol.K8s)
+    k8s.request_timeout = None
+    k8s.scheduler = netpol.RequestScheduler(**limits)
+    return k8s
+
+
+def api_exception(status, retry_after=None):
+    exc = kubernetes.client.rest.ApiException(status=status)
+    exc.headers = {'Retry-After': retry_after} if retry_after else None
+    return exc
+
+
+def test_call_api_reraises_original_exception():
+    k8s = k8s_with_scheduler(retries=2, backoff=0.001)
+    error = api_exception(429, '0')
+
+    def request():
+        raise error
+
+    with pytest.raises(kubernetes.client.rest.ApiException) as exc_info:
+        k8s.call_api(request)
+    assert exc_info.value is error
+    assert k8s.scheduler.stats()['retries'] == 2
+
+
+def test_call_api_does_not_retry_other_errors():
+    k8s = k8s_with_scheduler(retries=2, backoff=0.001)
+    error = api_exception(404)
+
+    def request():
+        raise error
+
+    with pytest.raises(kubernetes.client.rest.ApiException) as exc_info:
+        k8s.call_api(request)
+    assert exc_info.value is error
+    assert 'retries' not in k8s.scheduler.stats()
+
+
+def test_call_api_retries_throttled_request():
+    k8s = k8s_with_scheduler(retries=2, backoff=0.001)
+    attempts = [0]
+
+    def request(name, *, _request_timeout=None):
+        attempts[0] += 1
+        if attempts[0] == 1:
+            raise api_exception(503)
+        return name
+
+    assert k8s.call_api(request, 'netpol') == 'netpol'
+    assert attempts[0] == 2
+
+
+def test_parse_retry_after():
+    assert netpol.parse_retry_after('3') == 3.0
+    assert netpol.parse_retry_after('-1') == 0.0
+    assert netpol.parse_retry_after(None) is None
+    assert netpol.parse_retry_after('soon') is None
+
+    future = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < netpol.parse_retry_after(future) <= 30
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert netpol.parse_retry_after(past) == 0.0